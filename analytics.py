@@ -0,0 +1,143 @@
+"""Аналитика загрузки техники на NumPy.
+
+Записи за период читаются одним запросом и раскладываются в матрицы
+статус × техника × день; разбивка по неделям/месяцам считается
+векторно (np.add.at / np.add.reduceat), без циклов по записям.
+"""
+import numpy as np
+
+STATUSES = ("work", "stop", "repair", "holiday")
+PERIODS = ("week", "month")
+# Часы какого статуса входят в учтённое время: выходные не снижают загрузку
+LOGGED_STATUSES = ("work", "stop", "repair")
+
+_STATUS_CASE = "CASE r.status " + " ".join(f"WHEN '{s}' THEN {i}" for i, s in enumerate(STATUSES)) + " END"
+
+
+def load_fleet_matrix(conn, date_from, date_to, machine_ids):
+    """Матрицы по дням периода [date_from, date_to] (строки 'YYYY-MM-DD').
+
+    machine_ids - отсортированный список техники (строки матриц).
+    Возвращает (days, minutes, present):
+      days    - datetime64[D] длины D,
+      minutes - int64 (статус, техника, день), сумма минут,
+      present - bool (статус, техника, день), была ли запись с этим статусом.
+    """
+    days = np.arange(np.datetime64(date_from), np.datetime64(date_to)+1)
+    machines = np.asarray(machine_ids, dtype=np.int64)
+    shape = (len(STATUSES), len(machines), len(days))
+    minutes = np.zeros(shape, dtype=np.int64)
+    present = np.zeros(shape, dtype=bool)
+    if not len(days) or not len(machines):
+        return days, minutes, present
+
+    rows = conn.execute(f'''
+        SELECT r.machine_id,
+               CAST(julianday(r.date)-julianday(?) AS INTEGER),
+               {_STATUS_CASE},
+               r.minutes
+          FROM records r
+         WHERE r.date BETWEEN ? AND ?
+           AND r.machine_id IS NOT NULL
+    ''', (date_from, date_from, date_to)).fetchall()
+    if not rows:
+        return days, minutes, present
+
+    data = np.array(rows, dtype=np.int64)
+    pos = np.searchsorted(machines, data[:, 0])
+    pos = np.minimum(pos, len(machines)-1)
+    known = machines[pos]==data[:, 0]
+    status, machine, day, mins = data[known, 2], pos[known], data[known, 1], data[known, 3]
+    np.add.at(minutes, (status, machine, day), mins)
+    present[status, machine, day] = True
+    return days, minutes, present
+
+
+def period_keys(days, period):
+    """Начало недели (понедельник) или месяца для каждого дня."""
+    if period=="month":
+        return days.astype("datetime64[M]").astype("datetime64[D]")
+    # 1970-01-01 - четверг: сдвиг +3 даёт 0 для понедельника
+    return days-(days.astype(np.int64)+3) % 7
+
+
+def full_period_days(keys, period):
+    """Длина полной недели/месяца, начинающихся в keys."""
+    if period=="month":
+        month = keys.astype("datetime64[M]")
+        return ((month+1).astype("datetime64[D]")-month.astype("datetime64[D]")).astype(np.int64)
+    return np.full(len(keys), 7)
+
+
+def utilization(conn, date_from, date_to, machine_ids, period="month"):
+    """Загрузка по технике и периодам.
+
+    Для каждой техники и периода: часы и дни по статусам, дни без записей,
+    загрузка (% часов работы от часов работы, простоя и ремонта) и её
+    изменение к предыдущему периоду в процентных пунктах. fleet - то же по всему парку.
+
+    Периоды обрезаются границами [date_from, date_to]: подпись - первый день
+    периода внутри диапазона, в period_ranges - границы и признак partial
+    (неполная неделя/месяц). Изменение считается только между двумя полными
+    периодами, иначе trend - None.
+    """
+    days, minutes, present = load_fleet_matrix(conn, date_from, date_to, machine_ids)
+    if not len(days):
+        return {"periods": [], "period_ranges": [], "machines": [], "fleet": []}
+
+    keys = period_keys(days, period)
+    starts = np.flatnonzero(np.r_[True, keys[1:]!=keys[:-1]])
+    ends = np.r_[starts[1:], len(days)]-1
+    period_days = ends-starts+1
+    full = period_days==full_period_days(keys[starts], period)
+    comparable = full & np.r_[False, full[:-1]]
+
+    hours = np.add.reduceat(minutes, starts, axis=2)/60                 # (S, M, P)
+    status_days = np.add.reduceat(present, starts, axis=2)              # (S, M, P)
+    idle_days = np.add.reduceat(~present.any(axis=0), starts, axis=1)   # (M, P)
+    logged_idx = [STATUSES.index(s) for s in LOGGED_STATUSES]
+    work_idx = STATUSES.index("work")
+
+    def share(work, logged):
+        pct = np.full(logged.shape, np.nan)
+        np.divide(work*100, logged, out=pct, where=logged>0)
+        return pct
+
+    def trend(pct):
+        return np.where(comparable, np.diff(pct, axis=-1, prepend=np.nan), np.nan)
+
+    util = share(hours[work_idx], hours[logged_idx].sum(axis=0))        # (M, P)
+    fleet_hours = hours.sum(axis=1)                                     # (S, P)
+    fleet_util = share(fleet_hours[work_idx], fleet_hours[logged_idx].sum(axis=0))
+
+    def num(value, digits=2):
+        return None if np.isnan(value) else round(float(value), digits)
+
+    def cell(h, d, idle, pct, delta, n_days):
+        return {
+            "hours": {s: num(h[i]) for i, s in enumerate(STATUSES)},
+            "days": {s: int(d[i]) for i, s in enumerate(STATUSES)},
+            "idle_days": int(idle),
+            "period_days": int(n_days),
+            "utilization": num(pct, 1),
+            "trend": num(delta, 1),
+        }
+
+    util_trend = trend(util)
+    machines = []
+    for m, machine_id in enumerate(machine_ids):
+        machines.append({
+            "machine_id": int(machine_id),
+            "periods": [cell(hours[:, m, p], status_days[:, m, p], idle_days[m, p], util[m, p],
+                             util_trend[m, p], period_days[p]) for p in range(len(starts))],
+        })
+    fleet_trend = trend(fleet_util)
+    fleet = [cell(fleet_hours[:, p], status_days.sum(axis=1)[:, p], idle_days.sum(axis=0)[p],
+                  fleet_util[p], fleet_trend[p], period_days[p]*len(machine_ids)) for p in range(len(starts))]
+    return {
+        "periods": [str(days[i]) for i in starts],
+        "period_ranges": [{"start": str(days[a]), "end": str(days[b]), "days": int(n), "partial": not bool(f)}
+                          for a, b, n, f in zip(starts, ends, period_days, full)],
+        "machines": machines,
+        "fleet": fleet,
+    }
@@ -1,9 +1,32 @@
+import atexit
+import csv
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import re
 import sqlite3
-from flask import Flask, request, redirect, send_file, url_for
-from datetime import datetime, timedelta
-from openpyxl import Workbook
-from openpyxl.styles import PatternFill, Font
-from openpyxl.utils import get_column_letter
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import groupby
+from urllib.parse import urlencode
+from flask import Flask, Response, g, has_app_context, has_request_context, jsonify, make_response, request, redirect, send_file, stream_with_context, url_for
+from datetime import MAXYEAR, MINYEAR, date, datetime, timedelta
+from itsdangerous import BadSignature, URLSafeSerializer
+from markupsafe import escape
+from openpyxl import Workbook, load_workbook
+
+import analytics
+import xlsx_report
+from xlsx_report import format_date
 
 app = Flask(__name__)
 
@@ -44,6 +67,20 @@ def init_db():
 app.secret_key = 'supersecretkey123'
 app.config['DATABASE'] = 'an30.db'
 app.config['SQLITE_TIMEOUT'] = 20
+app.config['SQLITE_JOURNAL_MODE'] = 'WAL'
+# PRAGMA каждого нового соединения
+app.config['SQLITE_PRAGMAS'] = {
+    'foreign_keys': 'ON',
+    'synchronous':  'NORMAL',     # в режиме WAL надёжно и без fsync на каждый commit
+    'cache_size':   -32000,       # ~32 МБ кэша страниц
+    'mmap_size':    268435456,    # 256 МБ чтения через mmap
+    'temp_store':   'MEMORY',     # временные B-деревья сортировок в памяти
+}
+# Выделение id: 'reuse' - наименьший свободный id (дыры после удалений
+# переиспользуются), 'monotonic' - больше любого когда-либо выданного (id_high_water).
+app.config['ID_ALLOCATION'] = 'reuse'
+# Поиск по комментарию через FTS5 (init_db выключает, если FTS5 недоступен)
+app.config['COMMENT_FTS'] = True
 
 COLORS = {
     'primary': "#6C7A89",
@@ -59,12 +96,11 @@ COLORS = {
     }
 }
 
-RECORDS_PER_PAGE = 10  # Пагинация: число записей на странице
-
 def init_db():
     with app.app_context():
-        conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_TIMEOUT'])
-        conn.execute("PRAGMA foreign_keys = ON")
+        conn = connect_db()
+        # WAL хранится в самом файле БД: читатели не ждут писателей
+        conn.execute(f"PRAGMA journal_mode = {app.config['SQLITE_JOURNAL_MODE']}")
         c = conn.cursor()
 
         # Раскомментировать при необходимости пересоздания таблиц (удалит данные!):
@@ -103,258 +139,809 @@ def init_db():
                 comment TEXT,
                 counterparty_id INTEGER,
                 status TEXT NOT NULL CHECK(status IN ('work', 'stop', 'repair', 'holiday')),
+                minutes INTEGER NOT NULL DEFAULT 0,
                 FOREIGN KEY(machine_id) REFERENCES machines(id) ON DELETE SET NULL,
                 FOREIGN KEY(driver_id) REFERENCES drivers(id) ON DELETE SET NULL,
                 FOREIGN KEY(counterparty_id) REFERENCES counterparties(id) ON DELETE SET NULL
             )
         ''')
+        migrate_record_minutes(conn)
+        migrate_indexes(conn)
+        migrate_id_free_list(conn)
+        migrate_comment_fts(conn)
+        migrate_data_versions(conn)
+        migrate_records_versions(conn)
+        migrate_calendar_cache(conn)
+        migrate_monthly_hours(conn)
+        migrate_export_jobs(conn)
         conn.commit()
         conn.close()
 
+# Индексы под фильтры и сортировки /admin/records, /export и календаря.
+# Имя -> определение; init_db создаёт недостающие и пересоздаёт изменённые.
+DB_INDEXES = {
+    'idx_records_date':         'records(date)',
+    'idx_records_machine_date': 'records(machine_id, date, status, driver_id, counterparty_id, start_time, end_time)',
+    'idx_records_driver_date':  'records(driver_id, date)',
+    'idx_records_cparty_date':  'records(counterparty_id, date)',
+    'idx_records_status_date':  'records(status, date)',
+    'idx_records_minutes_date': 'records(minutes, date)',
+}
+
+def migrate_indexes(conn):
+    """Приводит индексы idx_* в базе к DB_INDEXES. Данные не трогает."""
+    existing = dict(conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type='index' AND name LIKE 'idx\\_%' ESCAPE '\\'"
+    ).fetchall())
+    changed = False
+    for name, sql in existing.items():
+        if name not in DB_INDEXES or sql != f"CREATE INDEX {name} ON {DB_INDEXES[name]}":
+            conn.execute(f"DROP INDEX {name}")
+            changed = True
+    existing = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    for name, definition in DB_INDEXES.items():
+        if name not in existing:
+            conn.execute(f"CREATE INDEX {name} ON {definition}")
+            changed = True
+    if changed:
+        # Статистика для планировщика, чтобы он выбирал подходящий индекс
+        conn.execute("ANALYZE")
+
+_thread_db = threading.local()
+
+# Операторы, на которых писатель ждёт блокировку БД: явный BEGIN IMMEDIATE/EXCLUSIVE
+# и первая запись вне транзакции (sqlite3 сам открывает транзакцию перед DML)
+LOCK_SQL_RE = re.compile(r"\s*(BEGIN\s+(IMMEDIATE|EXCLUSIVE)|INSERT|UPDATE|DELETE|REPLACE)\b", re.I)
+
+def _timed_sql(conn, method, sql, *args):
+    """Выполняет метод курсора, передавая время в метрики и трассировку SQL."""
+    stats = g.get('sql_stats') if has_request_context() else None
+    traced = getattr(conn, 'traced', None)
+    if stats is None and traced is None:
+        return method(sql, *args)
+    waits = LOCK_SQL_RE.match(sql) and (sql.lstrip()[:5].upper()=='BEGIN' or not conn.in_transaction)
+    locked = False
+    if traced is not None:
+        traced.clear()
+    t0 = time.perf_counter()
+    try:
+        return method(sql, *args)
+    except sqlite3.OperationalError as e:
+        locked = 'locked' in str(e)
+        raise
+    finally:
+        elapsed = time.perf_counter()-t0
+        if stats is not None:
+            stats['statements'] += 1
+            stats['seconds'] += elapsed
+            if waits or locked:
+                stats['lock_wait'] += elapsed
+            stats['locked'] += locked
+        if traced is not None:
+            trace_sql(conn, sql, args[0] if args else (), elapsed, method.__name__=='executemany')
+
+class MetricsCursor(sqlite3.Cursor):
+    def execute(self, sql, *args):
+        return _timed_sql(self.connection, super().execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return _timed_sql(self.connection, super().executemany, sql, *args)
+
+class MetricsConnection(sqlite3.Connection):
+    """Соединение, которое считает операторы, время SQL и ожидание блокировок (см. МЕТРИКИ)."""
+    def cursor(self, factory=MetricsCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        return self.cursor().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        return self.cursor().executemany(sql, *args)
+
+def connect_db():
+    """Новое соединение с PRAGMA из SQLITE_PRAGMAS."""
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_TIMEOUT'],
+                           factory=MetricsConnection)
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    if app.config['SQL_TRACE']:
+        # SQLite сообщает каждый шаг оператора с подставленными параметрами,
+        # включая операторы триггеров ("-- TRIGGER ...")
+        conn.traced = []
+        conn.set_trace_callback(conn.traced.append)
+    return conn
+
 def get_db():
-    conn = sqlite3.connect(app.config['DATABASE'], timeout=app.config['SQLITE_TIMEOUT'])
-    conn.execute("PRAGMA foreign_keys = ON")
+    """Соединение с БД: одно на запрос (контекст приложения), вне контекста - одно на поток.
+
+    Закрывать его не нужно - это делает close_db при завершении контекста.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = connect_db()
+        return g.db
+    conn = getattr(_thread_db, 'conn', None)
+    if conn is None or _thread_db.path!=app.config['DATABASE']:
+        if conn is not None:
+            conn.close()
+        conn = _thread_db.conn = connect_db()
+        _thread_db.path = app.config['DATABASE']
+    return conn
+
+@app.teardown_appcontext
+def close_db(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        # Незавершённая транзакция (ошибка в обработчике) не должна держать блокировку
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+# --------------------- МЕТРИКИ ---------------------
+
+# Каждый воркер копит приращения у себя и раз в METRICS_FLUSH_INTERVAL секунд
+# добавляет их в отдельную базу METRICS_DATABASE; /metrics отдаёт сумму по всем воркерам.
+app.config['METRICS_ENABLED'] = True
+app.config['METRICS_DATABASE'] = None      # None - рядом с DATABASE: an30-metrics.db
+app.config['METRICS_FLUSH_INTERVAL'] = 5
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS = {
+    'an30_http_requests_total':             ('counter',   'Запросы по маршруту, методу и коду ответа'),
+    'an30_http_request_duration_seconds':   ('histogram', 'Время обработки запроса, включая потоковую отдачу'),
+    'an30_sql_statements_total':            ('counter',   'SQL-операторы, выполненные при обработке запросов'),
+    'an30_sql_duration_seconds_total':      ('counter',   'Время выполнения SQL-операторов'),
+    'an30_sqlite_lock_wait_seconds_total':  ('counter',   'Время операторов, захватывающих блокировку записи'),
+    'an30_sqlite_locked_errors_total':      ('counter',   'Ошибки "database is locked"'),
+}
+_metrics_pending = {}
+_metrics_lock = threading.Lock()
+_metrics_flushed = time.monotonic()
+
+def metrics_db_path():
+    return app.config['METRICS_DATABASE'] or os.path.splitext(app.config['DATABASE'])[0]+'-metrics.db'
+
+def connect_metrics_db():
+    conn = sqlite3.connect(metrics_db_path(), timeout=app.config['SQLITE_TIMEOUT'])
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        ) WITHOUT ROWID
+    ''')
     return conn
 
+def _metric_labels(**labels):
+    return ",".join(f'{k}="{v}"' for k, v in labels.items())
+
+def _metric_add(name, labels, value):
+    _metrics_pending[(name, labels)] = _metrics_pending.get((name, labels), 0)+value
+
+def flush_metrics(force=False):
+    """Переносит накопленные приращения в общую базу метрик."""
+    global _metrics_pending, _metrics_flushed
+    with _metrics_lock:
+        if not _metrics_pending or not force and time.monotonic()-_metrics_flushed<app.config['METRICS_FLUSH_INTERVAL']:
+            return
+        pending, _metrics_pending = _metrics_pending, {}
+        _metrics_flushed = time.monotonic()
+    try:
+        conn = connect_metrics_db()
+        try:
+            with conn:
+                conn.executemany('''
+                    INSERT INTO metrics (name, labels, value) VALUES (?,?,?)
+                    ON CONFLICT(name, labels) DO UPDATE SET value = value+excluded.value
+                ''', [(name, labels, value) for (name, labels), value in pending.items()])
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        # Не удалось записать - вернём приращения, допишем при следующем сбросе
+        with _metrics_lock:
+            for (name, labels), value in pending.items():
+                _metric_add(name, labels, value)
+
+@app.before_request
+def start_request_metrics():
+    if app.config['METRICS_ENABLED']:
+        g.request_started = time.perf_counter()
+        g.sql_stats = {'statements': 0, 'seconds': 0.0, 'lock_wait': 0.0, 'locked': 0}
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+def stream_in_request(generator):
+    """stream_with_context с пометкой для метрик: у такого ответа teardown вызывается дважды.
+
+    send_file тоже отдаёт потоковый ответ (is_streamed), но teardown у него один,
+    поэтому помечаем только тела, обёрнутые здесь.
+    """
+    g.response_streamed = True
+    return stream_with_context(generator)
+
+@app.teardown_request
+def record_request_metrics(exc):
+    """Метрики запроса. Для потоковых ответов - после отдачи всего тела."""
+    if g.pop('response_streamed', False) and exc is None:
+        # stream_with_context вызывает teardown дважды: после обработчика и после
+        # последнего куска ответа - считаем по второму вызову
+        return
+    started = g.pop('request_started', None)
+    stats = g.pop('sql_stats', None)
+    if started is None:
+        return
+    elapsed = time.perf_counter()-started
+    endpoint = request.endpoint or 'unknown'
+    status = 500 if exc is not None else g.get('response_status', 500)
+    ep = _metric_labels(endpoint=endpoint)
+    with _metrics_lock:
+        _metric_add('an30_http_requests_total', _metric_labels(endpoint=endpoint, method=request.method, status=status), 1)
+        for le in METRICS_BUCKETS:
+            _metric_add('an30_http_request_duration_seconds_bucket', f'{ep},le="{le}"', int(elapsed<=le))
+        _metric_add('an30_http_request_duration_seconds_bucket', f'{ep},le="+Inf"', 1)
+        _metric_add('an30_http_request_duration_seconds_sum', ep, elapsed)
+        _metric_add('an30_http_request_duration_seconds_count', ep, 1)
+        _metric_add('an30_sql_statements_total', ep, stats['statements'])
+        _metric_add('an30_sql_duration_seconds_total', ep, stats['seconds'])
+        _metric_add('an30_sqlite_lock_wait_seconds_total', ep, stats['lock_wait'])
+        _metric_add('an30_sqlite_locked_errors_total', ep, stats['locked'])
+    flush_metrics()
+
+def _metric_family(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+def _metric_sort_key(row):
+    # Корзины гистограммы - по возрастанию границы le, +Inf последней
+    name, labels, _ = row
+    base, _, le = labels.partition(',le="')
+    return name, base, float(le.rstrip('"').replace('+Inf', 'inf') or 0)
+
+@app.route('/metrics')
+def metrics():
+    """Метрики всех воркеров в текстовом формате Prometheus."""
+    flush_metrics(force=True)
+    conn = connect_metrics_db()
+    try:
+        rows = conn.execute("SELECT name, labels, value FROM metrics").fetchall()
+    finally:
+        conn.close()
+    by_family = {}
+    for name, labels, value in sorted(rows, key=_metric_sort_key):
+        by_family.setdefault(_metric_family(name), []).append((name, labels, value))
+    lines = []
+    for family, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {family} {help_text}")
+        lines.append(f"# TYPE {family} {kind}")
+        for name, labels, value in by_family.get(family, []):
+            lines.append(f"{name}{{{labels}}} {value!r}")
+    return Response("\n".join(lines)+"\n", mimetype='text/plain; version=0.0.4')
+
+@atexit.register
+def _flush_metrics_at_exit():
+    if app.config['METRICS_ENABLED']:
+        flush_metrics(force=True)
+
+# --------------------- ТРАССИРОВКА SQL ---------------------
+
+# Включается явно: время каждого оператора, журнал медленных с параметрами и
+# EXPLAIN QUERY PLAN, разбор запросов текущей страницы по ?sql_trace=1.
+app.config['SQL_TRACE'] = False
+app.config['SQL_SLOW_MS'] = 100     # Операторы дольше этого пишутся в журнал an30.sql
+EXPLAIN_SQL_RE = re.compile(r"\s*(SELECT|WITH|INSERT|UPDATE|DELETE|REPLACE)\b", re.I)
+sql_log = logging.getLogger('an30.sql')
+
+def explain_query_plan(conn, sql, params):
+    """Строки EXPLAIN QUERY PLAN с отступами по дереву плана."""
+    if not EXPLAIN_SQL_RE.match(sql):
+        return []
+    try:
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN "+sql, params).fetchall()
+    except sqlite3.Error as e:
+        return [f"(план недоступен: {e})"]
+    depth = {0: 0}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, 0)+1
+        lines.append("  "*(depth[node]-1)+detail)
+    return lines
+
+def trace_sql(conn, sql, params, elapsed, many=False):
+    """Учёт выполненного оператора: в разбор запроса и, если медленный, в журнал."""
+    ms = elapsed*1000
+    steps = list(conn.traced)
+    entry = {
+        'sql': " ".join(sql.split()),
+        'params': f"{len(params)} наборов" if many else repr(tuple(params) if isinstance(params, (list, tuple)) else params),
+        'ms': ms,
+        'steps': steps[1:21],   # первый шаг - сам оператор, дальше триггеры и т.п.
+        'plan': None,
+    }
+    slow = ms>=app.config['SQL_SLOW_MS']
+    page = has_request_context() and request.args.get('sql_trace')=='1'
+    if slow or page:
+        entry['plan'] = explain_query_plan(conn, sql, () if many else params)
+    if slow:
+        sql_log.warning("медленный SQL %.1f мс: %s\nпараметры: %s\nплан:\n  %s",
+                        ms, entry['sql'], entry['params'], "\n  ".join(entry['plan']) or "-")
+    if has_request_context():
+        g.setdefault('sql_trace', []).append(entry)
+
+def render_sql_trace(entries):
+    total = sum(e['ms'] for e in entries)
+    rows = []
+    for i, e in enumerate(sorted(entries, key=lambda e: -e['ms']), 1):
+        extra = "".join(f"<div class='sql-step'>{escape(step)}</div>" for step in e['steps'])
+        if e['plan']:
+            extra += f"<pre>{escape(chr(10).join(e['plan']))}</pre>"
+        rows.append(f"<tr><td>{i}</td><td>{e['ms']:.2f}</td><td><code>{escape(e['sql'])}</code>{extra}</td>"
+                    f"<td><code>{escape(e['params'])}</code></td></tr>")
+    return f'''<div class="container sql-trace">
+        <h3>SQL: {len(entries)} оператор(ов), {total:.1f} мс</h3>
+        <table><tr><th>#</th><th>мс</th><th>Оператор</th><th>Параметры</th></tr>{"".join(rows)}</table>
+    </div>'''
+
+@app.after_request
+def sql_trace_report(response):
+    """X-SQL-Queries/X-SQL-Time-ms в ответе; ?sql_trace=1 добавляет разбор в конец HTML-страницы.
+
+    Потоковые ответы (печать всех записей, CSV/NDJSON) выполняют запросы уже после
+    этого хука: для них заголовки не отражают запросы тела, а разбор не добавляется.
+    """
+    if not app.config['SQL_TRACE']:
+        return response
+    entries = g.get('sql_trace', [])
+    response.headers['X-SQL-Queries'] = str(len(entries))
+    response.headers['X-SQL-Time-ms'] = f"{sum(e['ms'] for e in entries):.1f}"
+    if request.args.get('sql_trace')=='1' and response.mimetype=='text/html' and not response.is_streamed:
+        html = response.get_data(as_text=True)
+        report = render_sql_trace(entries)
+        html = html.replace("</body>", report+"</body>") if "</body>" in html else html+report
+        response.set_data(html)
+    return response
+
+ID_TABLES = ('machines', 'drivers', 'counterparties', 'records')
+
+def migrate_comment_fts(conn):
+    """Полнотекстовый индекс FTS5 по records.comment и триггеры синхронизации.
+
+    При первом создании индекс заполняется из существующих записей. Если
+    SQLite собран без FTS5, поиск по комментарию остаётся на LIKE.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='records_fts'"
+    ).fetchone() is not None
+    if not exists:
+        try:
+            conn.execute('''
+                CREATE VIRTUAL TABLE records_fts USING fts5(
+                    comment,
+                    content='records',
+                    content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+        except sqlite3.OperationalError:
+            app.config['COMMENT_FTS'] = False
+            return
+        conn.execute("INSERT INTO records_fts(records_fts) VALUES('rebuild')")
+    app.config['COMMENT_FTS'] = True
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_records_fts_ins AFTER INSERT ON records
+        BEGIN
+            INSERT INTO records_fts(rowid, comment) VALUES (NEW.id, NEW.comment);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_records_fts_del AFTER DELETE ON records
+        BEGIN
+            INSERT INTO records_fts(records_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_records_fts_upd AFTER UPDATE OF comment ON records
+        BEGIN
+            INSERT INTO records_fts(records_fts, rowid, comment) VALUES ('delete', OLD.id, OLD.comment);
+            INSERT INTO records_fts(rowid, comment) VALUES (NEW.id, NEW.comment);
+        END
+    ''')
+
+def migrate_id_free_list(conn):
+    """Таблица свободных id, отметка наибольшего выданного id и триггеры, которые их поддерживают.
+
+    При первом создании id_free_list заполняется дырами, уже имеющимися в таблицах.
+    """
+    created = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='id_free_list'"
+    ).fetchone() is None
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS id_free_list (
+            table_name TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, id)
+        ) WITHOUT ROWID
+    ''')
+    # Наибольший выданный id каждой таблицы: не уменьшается при удалении
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS id_high_water (
+            table_name TEXT PRIMARY KEY,
+            id INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    for t in ID_TABLES:
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_free_id_del AFTER DELETE ON {t}
+            BEGIN
+                INSERT OR IGNORE INTO id_free_list (table_name, id) VALUES ('{t}', OLD.id);
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_free_id_ins AFTER INSERT ON {t}
+            BEGIN
+                DELETE FROM id_free_list WHERE table_name='{t}' AND id=NEW.id;
+            END
+        ''')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{t}_high_water AFTER INSERT ON {t}
+            BEGIN
+                INSERT INTO id_high_water (table_name, id) VALUES ('{t}', NEW.id)
+                ON CONFLICT(table_name) DO UPDATE SET id=MAX(id, excluded.id);
+            END
+        ''')
+        # Для старых баз отметка начинается с текущего MAX(id)
+        conn.execute(f"INSERT OR IGNORE INTO id_high_water (table_name, id) SELECT '{t}', IFNULL(MAX(id),0) FROM {t}")
+        if created:
+            expected = 1
+            gaps = []
+            for (id_,) in conn.execute(f"SELECT id FROM {t} ORDER BY id"):
+                gaps.extend((t, i) for i in range(expected, id_))
+                expected = id_ + 1
+            conn.executemany("INSERT INTO id_free_list (table_name, id) VALUES (?,?)", gaps)
+
 def get_next_free_id(conn, table_name: str) -> int:
-    rows = conn.execute(f"SELECT id FROM {table_name} ORDER BY id").fetchall()
-    used = {r[0] for r in rows}
-    candidate = 1
-    while candidate in used:
-        candidate += 1
-    return candidate
+    """Следующий id для вставки в table_name.
+
+    Открывает транзакцию BEGIN IMMEDIATE (если она ещё не открыта), поэтому
+    выбранный id занят за этим соединением до commit - параллельные воркеры
+    ждут блокировку записи, а не получают тот же id.
+    """
+    if table_name not in ID_TABLES:
+        raise ValueError(f"Неизвестная таблица: {table_name}")
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    if app.config['ID_ALLOCATION'] == 'reuse':
+        row = conn.execute(
+            "SELECT MIN(id) FROM id_free_list WHERE table_name=?", (table_name,)
+        ).fetchone()
+        if row[0] is not None:
+            return row[0]
+    return _id_top(conn, table_name)+1
+
+def _id_top(conn, table_name):
+    """Наибольший id, когда-либо выданный в table_name (удалённые тоже считаются)."""
+    return conn.execute(
+        f"SELECT MAX(IFNULL((SELECT id FROM id_high_water WHERE table_name=?),0), IFNULL(MAX(id),0)) FROM {table_name}",
+        (table_name,)
+    ).fetchone()[0]
+
+def get_next_free_ids(conn, table_name: str, count: int) -> list:
+    """count id для пакетной вставки - то же, что count вызовов get_next_free_id."""
+    if table_name not in ID_TABLES:
+        raise ValueError(f"Неизвестная таблица: {table_name}")
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    ids = []
+    if app.config['ID_ALLOCATION'] == 'reuse':
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM id_free_list WHERE table_name=? ORDER BY id LIMIT ?", (table_name, count)
+        )]
+    top = _id_top(conn, table_name)
+    ids.extend(range(top+1, top+1+count-len(ids)))
+    return ids
+
+# --------------------- СТАТИКА ---------------------
+
+STATIC_MAX_AGE = 365*24*3600  # Файлы со ссылкой ?v=<хэш> кэшируются браузером на год
+STATIC_ASSETS = ('app.css', 'app.js')
+_static_versions = {}
+
+def static_version(filename):
+    """Хэш содержимого файла из static/ (вычисляется один раз на процесс)."""
+    version = _static_versions.get(filename)
+    if version is None:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = hashlib.sha256(f.read()).hexdigest()[:12]
+        _static_versions[filename] = version
+    return version
+
+def static_url(filename):
+    """URL файла из static/ с хэшем содержимого: изменился файл - изменился и URL."""
+    return f"{app.static_url_path}/{filename}?v={static_version(filename)}"
+
+@app.after_request
+def cache_static_assets(response):
+    """Надолго кэшируется только URL с текущим хэшем файла; старый или чужой ?v= - no-cache,
+    иначе браузеры и прокси навсегда запомнят под ним то, что лежит сейчас."""
+    if request.endpoint=='static' and request.args.get('v') and response.status_code==200:
+        if request.args['v']==static_version(request.view_args['filename']):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.public = None
+            response.cache_control.max_age = None
+            response.cache_control.no_cache = True
+    return response
 
-def render_base(content):
-    """Главный шаблон со стилями и отступами."""
+def base_head():
     return f'''<!DOCTYPE html>
 <html>
 <head>
     <title>АН-30 Учёт</title>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1">
-    <style>
-        * {{
-            box-sizing: border-box; margin: 0; padding: 0;
-        }}
-        body {{
-            font-family: 'Segoe UI', sans-serif;
-            background: {COLORS['background']};
-            color: {COLORS['primary']};
-        }}
-        .header {{
-            background: {COLORS['primary']};
-            padding: 1rem;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-        }}
-        .nav {{
-            max-width: 1200px;
-            margin: 0 auto;
-            display: flex;
-            gap: 1rem;
-        }}
-        .nav a {{
-            color: white;
-            text-decoration: none;
-            padding: 0.5rem 1rem;
-            border-radius: 4px;
-            transition: 0.3s;
-            font-weight: bold;
-        }}
-        .nav a:hover {{
-            background: {COLORS['secondary']};
-        }}
-        .container {{
-            max-width: 1200px;
-            margin: 2rem auto;
-            padding: 0 1rem;
-        }}
-        .card {{
-            background: white;
-            border-radius: 8px;
-            padding: 1.5rem;
-            box-shadow: 0 2px 5px rgba(0,0,0,0.05);
-            margin-bottom: 1rem;
-        }}
-        table {{
-            width: 100%;
-            border-collapse: collapse;
-            margin-top: 1rem;
-        }}
-        th, td {{
-            padding: 1rem;
-            text-align: left;
-            border-bottom: 1px solid #eee;
-        }}
-        th {{
-            background: {COLORS['primary']};
-            color: white;
-            cursor: pointer;
-        }}
-        .status {{
-            display: inline-block;
-            padding: 0.25rem 0.75rem;
-            border-radius: 1rem;
-            font-size: 0.9em;
-        }}
-        .btn {{
-            background: {COLORS['accent']};
-            color: white;
-            padding: 0.5rem 1rem;
-            border: none;
-            border-radius: 4px;
-            cursor: pointer;
-            transition: 0.3s;
-            font-weight: bold;
-            margin: 0 0.25rem 0.25rem 0;
-        }}
-        .btn-danger {{
-            background: {COLORS['danger']} !important;
-        }}
-        .btn:hover {{
-            opacity: 0.9;
-        }}
-        .back-btn {{
-            background: {COLORS['secondary']};
-            margin: 1rem 0; 
-        }}
-        form {{
-            display: flex;
-            gap: 1rem;
-            flex-wrap: wrap;
-        }}
-        input, select {{
-            padding: 0.5rem;
-            border: 1px solid #ddd;
-            border-radius: 4px;
-            min-width: 150px;
-        }}
-        .action-buttons {{
-            display: inline-flex;
-            gap: 0.5rem;
-        }}
-        .calendar-grid {{
-            display: grid;
-            grid-template-columns: repeat(7, 1fr);
-            gap: 0.5rem;
-            margin-top: 1rem;
-        }}
-        .calendar-day {{
-            background: white;
-            padding: 1rem;
-            border-radius: 8px;
-            min-height: 120px;
-            box-shadow: 0 1px 3px rgba(0,0,0,0.1);
-        }}
-        .filters {{
-            margin-bottom: 1rem;
-        }}
-        .pagination {{
-            margin-top: 1rem;
-            display: flex;
-            gap: 0.5rem;
-        }}
-        .pagination span {{
-            padding: 0.5rem 1rem;
-        }}
-
-        /* Специально для отступов в заголовках/кнопках */
-        .calendar-header {{
-            display: flex;
-            align-items: center;
-            gap: 1rem;
-            flex-wrap: wrap;
-            margin-top: 1rem;
-        }}
-        .calendar-header h1 {{
-            margin: 0;
-            font-size: 1.5rem;
-        }}
-        .calendar-nav-btns {{
-            display: inline-flex;
-            gap: 1rem;
-        }}
-    </style>
+    <link rel="stylesheet" href="{static_url('app.css')}">
 </head>
 <body>
     <header class="header">
         <nav class="nav">
             <a href="/">Главная</a>
+            <a href="/calendar">Календарь</a>
             <a href="/admin">Админка</a>
-            <a href="/export">&#128202; Отчёт (все)</a>
+            <a href="/export?job=1">&#128202; Отчёт (все)</a>
         </nav>
     </header>
     <div class="container">
-        {content}
+'''
+
+def base_tail():
+    return f'''
     </div>
-    <script>
-        function confirmDelete(msg) {{
-            return confirm(msg || 'Вы уверены что хотите удалить запись?');
-        }}
-        function sortBy(sortField) {{
-            const url = new URL(window.location.href);
-            let currentSort = url.searchParams.get('sort');
-            if (currentSort === sortField + '_asc') {{
-                url.searchParams.set('sort', sortField + '_desc');
-            }} else {{
-                url.searchParams.set('sort', sortField + '_asc');
-            }}
-            window.location.href = url.toString();
-        }}
-    </script>
+    <script src="{static_url('app.js')}"></script>
 </body>
 </html>'''
 
+def render_base(content):
+    """Главный шаблон; стили и скрипты подключаются из static/ (app.css, app.js)."""
+    return base_head()+content+base_tail()
+
+def stream_base(parts):
+    """Главный шаблон по частям: шапка уходит клиенту сразу, затем куски parts и подвал.
+
+    Отдавать через Response(stream_in_request(...)) - части читают БД из контекста запроса.
+    """
+    yield base_head()
+    yield from parts
+    yield base_tail()
+
 # --------------------- ВСТАВКА / УТИЛИТЫ ---------------------
 
 def insert_machine(name: str):
     conn = get_db()
-    try:
-        new_id = get_next_free_id(conn, "machines")
-        conn.execute("INSERT INTO machines (id,name) VALUES (?,?)", (new_id,name))
-        conn.commit()
-    finally:
-        conn.close()
+    new_id = get_next_free_id(conn, "machines")
+    conn.execute("INSERT INTO machines (id,name) VALUES (?,?)", (new_id,name))
+    conn.commit()
 
 def insert_driver(name: str):
     conn = get_db()
-    try:
-        new_id = get_next_free_id(conn, "drivers")
-        conn.execute("INSERT INTO drivers (id,name) VALUES (?,?)", (new_id,name))
-        conn.commit()
-    finally:
-        conn.close()
+    new_id = get_next_free_id(conn, "drivers")
+    conn.execute("INSERT INTO drivers (id,name) VALUES (?,?)", (new_id,name))
+    conn.commit()
 
 def insert_counterparty(name: str):
     conn = get_db()
+    new_id = get_next_free_id(conn, "counterparties")
+    conn.execute("INSERT INTO counterparties (id,name) VALUES (?,?)", (new_id,name))
+    conn.commit()
+
+def calc_minutes(start_t, end_t):
+    """Минуты между HH:MM и HH:MM (через полночь - на следующий день).
+
+    Единственный расчёт длительности: им заполняются records.minutes и records.hours
+    на всех путях записи, он же - SQL-функция calc_minutes() в миграции.
+    """
+    if not (start_t and end_t):
+        return 0
     try:
-        new_id = get_next_free_id(conn, "counterparties")
-        conn.execute("INSERT INTO counterparties (id,name) VALUES (?,?)", (new_id,name))
-        conn.commit()
-    finally:
-        conn.close()
+        st=datetime.strptime(start_t,'%H:%M')
+        en=datetime.strptime(end_t,'%H:%M')
+    except ValueError:
+        return 0
+    if en<st: en+=timedelta(days=1)
+    return (en-st).seconds//60
+
+def record_durations(start_t, end_t):
+    """(hours, minutes) для INSERT/UPDATE records; hours - целые часы для старого столбца (7ч50м -> 7)."""
+    minutes = calc_minutes(start_t, end_t)
+    return minutes//60, minutes
+
+def format_minutes(minutes):
+    """7ч50м в виде "7:50"."""
+    minutes = minutes or 0
+    return f"{minutes//60}:{minutes%60:02d}"
+
+def migrate_record_minutes(conn):
+    """Столбец records.minutes; для старых баз - добавление и заполнение из start_time/end_time."""
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(records)")]
+    if 'minutes' in columns:
+        return
+    conn.execute("ALTER TABLE records ADD COLUMN minutes INTEGER NOT NULL DEFAULT 0")
+    conn.create_function('calc_minutes', 2, calc_minutes, deterministic=True)
+    conn.execute('''
+        UPDATE records SET minutes=calc_minutes(start_time, end_time)
+         WHERE start_time IS NOT NULL AND end_time IS NOT NULL
+    ''')
+    # Старые строки с пустым hours - по тем же минутам, что и в minutes
+    conn.execute("UPDATE records SET hours=minutes/60 WHERE hours IS NULL")
 
-def insert_record(date_str, machine_id, driver_id, status, start_time, end_time, hours, comment, counterparty_id):
+def insert_record(date_str, machine_id, driver_id, status, start_time, end_time, comment, counterparty_id):
     conn = get_db()
+    new_id = get_next_free_id(conn, "records")
+    conn.execute('''
+        INSERT INTO records
+        (id,date,machine_id,driver_id,status,start_time,end_time,hours,minutes,comment,counterparty_id)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+    ''',(new_id,date_str,machine_id,driver_id,status,start_time,end_time,
+          *record_durations(start_time,end_time),comment,counterparty_id))
+    conn.commit()
+
+# --------------------- КЭШ СПРАВОЧНИКОВ ---------------------
+
+REF_TABLES = ('machines', 'drivers', 'counterparties')
+_ref_cache = {}
+
+def migrate_data_versions(conn):
+    """Счётчики версий данных; триггеры увеличивают их при любом изменении справочников.
+
+    Счётчик лежит в самой БД, поэтому изменение видят все воркеры gunicorn.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    for t in REF_TABLES:
+        conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)", (t,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_{t}_version_{event.lower()} AFTER {event} ON {t}
+                BEGIN
+                    UPDATE data_versions SET version=version+1 WHERE name='{t}';
+                END
+            ''')
+
+def get_ref_data(conn):
+    """Справочники из кэша процесса: {таблица: {'version', 'rows', 'options'}}.
+
+    За запрос читаются только версии; списки перечитываются, когда версия
+    в data_versions изменилась. options - готовые <option> без selected.
+    """
+    versions = dict(conn.execute(
+        "SELECT name, version FROM data_versions WHERE name IN (?,?,?)", REF_TABLES
+    ).fetchall())
+    result = {}
+    for t in REF_TABLES:
+        key = (app.config['DATABASE'], t)
+        entry = _ref_cache.get(key)
+        if entry is None or entry['version']!=versions.get(t):
+            # Версию берём до чтения строк: при гонке с записью кэш лишь обновится ещё раз
+            rows = conn.execute(f"SELECT * FROM {t} ORDER BY id").fetchall()
+            entry = {
+                'version': versions.get(t),
+                'rows': rows,
+                'options': "".join(f'<option value="{r[0]}">{r[1]}</option>' for r in rows),
+            }
+            _ref_cache[key] = entry
+        result[t] = entry
+    return result
+
+def with_selected(options_html, value):
+    """Отмечает selected у варианта value в готовом списке options."""
+    if value is None:
+        return options_html
+    return options_html.replace(f'<option value="{value}">', f'<option value="{value}" selected>', 1)
+
+# --------------------- ВЕРСИИ ДАННЫХ И ETAG ---------------------
+
+def _records_version_sql(ref):
+    """Тело триггера: +1 к общей версии записей, к месяцу и к (технике, месяц) строки ref."""
+    return "".join(f'''
+        INSERT INTO data_versions (name, version) VALUES ({name}, 1)
+        ON CONFLICT(name) DO UPDATE SET version=version+1;''' for name in (
+            "'records:' || substr({0}.date,1,7)".format(ref),
+            "'records:m' || IFNULL({0}.machine_id,0) || ':' || substr({0}.date,1,7)".format(ref),
+        ))
+
+def migrate_records_versions(conn):
+    """Версии записей в data_versions: 'records', 'records:YYYY-MM', 'records:m<id>:YYYY-MM'."""
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('records', 0)")
+    bump_all = "UPDATE data_versions SET version=version+1 WHERE name='records';"
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_version_insert AFTER INSERT ON records
+        BEGIN {bump_all} {_records_version_sql("NEW")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_version_delete AFTER DELETE ON records
+        BEGIN {bump_all} {_records_version_sql("OLD")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_version_update AFTER UPDATE ON records
+        BEGIN {bump_all} {_records_version_sql("OLD")} {_records_version_sql("NEW")} END
+    ''')
+
+def get_data_versions(conn, names):
+    found = dict(conn.execute(
+        f"SELECT name, version FROM data_versions WHERE name IN ({','.join('?'*len(names))})", names
+    ).fetchall())
+    return [found.get(n, 0) for n in names]
+
+# Меняется при изменении кода/статики, чтобы после обновления не отдавать 304 на старую разметку
+with open(__file__, 'rb') as _f:
+    APP_BUILD = hashlib.sha256(_f.read()).hexdigest()[:12]
+
+def etag_by_versions(names_func):
+    """ETag страницы по версиям данных из data_versions.
+
+    names_func(**view_args) -> список имён версий. Если у клиента тот же
+    ETag, возвращается 304 без выполнения обработчика (и без запросов к records).
+    Применяется только к GET.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if request.method!='GET':
+                return view(**kwargs)
+            names = list(names_func(**kwargs))
+            versions = get_data_versions(get_db(), names)
+            raw = "|".join([APP_BUILD, *map(static_url, STATIC_ASSETS), *map(str, zip(names, versions))])
+            etag = hashlib.sha1(raw.encode()).hexdigest()
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                response = make_response(view(**kwargs))
+                if response.status_code!=200:
+                    return response
+            response.set_etag(etag)
+            # Браузер хранит страницу, но каждый раз сверяет ETag
+            response.cache_control.no_cache = True
+            response.cache_control.private = True
+            return response
+        return wrapper
+    return decorator
+
+def _calendar_versions(machine_id):
     try:
-        new_id = get_next_free_id(conn, "records")
-        conn.execute('''
-            INSERT INTO records
-            (id,date,machine_id,driver_id,status,start_time,end_time,hours,comment,counterparty_id)
-            VALUES (?,?,?,?,?,?,?,?,?,?)
-        ''',(new_id,date_str,machine_id,driver_id,status,start_time,end_time,hours,comment,counterparty_id))
-        conn.commit()
-    finally:
-        conn.close()
+        period = get_calendar_range()
+    except ValueError:
+        period = None
+    if period:
+        # В сетке периода нет имён водителей и контрагентов - только записи
+        return ['machines']+[f'records:m{machine_id}:{m}' for m in range_months(*period)]
+    year, month = get_calendar_month()
+    return ['machines', 'drivers', 'counterparties', f'records:m{machine_id}:{year:04d}-{month:02d}']
+
+def _calendar_day_versions(machine_id, day):
+    return ['drivers', 'counterparties', f'records:m{machine_id}:{day[:7]}']
+
+def _fleet_calendar_versions():
+    year, month = get_calendar_month()
+    return ['machines', 'drivers', 'counterparties', f'records:{year:04d}-{month:02d}']
 
 # --------------------- ГЛАВНАЯ ---------------------
 
 @app.route('/')
+@etag_by_versions(lambda: ['machines'])
 def index():
     conn = get_db()
-    try:
-        machines = conn.execute("SELECT * FROM machines ORDER BY id").fetchall()
-    finally:
-        conn.close()
+    machines = get_ref_data(conn)['machines']['rows']
     rows = ""
     for m in machines:
         rows += f"""
@@ -375,38 +962,49 @@ def index():
 
 # --------------------- КАЛЕНДАРЬ ---------------------
 
-@app.route('/calendar/<int:machine_id>')
-def calendar(machine_id):
+def month_dates(year, month):
+    """Список дней месяца (datetime) от первого до последнего числа."""
+    first_day = datetime(year,month,1)
+    last_day  = (first_day.replace(day=28)+timedelta(days=4)).replace(day=1)-timedelta(days=1)
+    return [first_day+timedelta(days=i) for i in range((last_day-first_day).days+1)]
+
+def load_calendar_records(conn, date_from, date_to, machine_id=None):
+    """Записи за период одним запросом, сгруппированные по (machine_id, date).
+
+    Возвращает словарь {(machine_id, 'YYYY-MM-DD'): [(водитель, статус, начало, конец, контрагент), ...]}.
+    """
+    where = "r.date>=? AND r.date<=?"
+    pr = [str(date_from), str(date_to)]
+    if machine_id is not None:
+        where += " AND r.machine_id=?"
+        pr.append(machine_id)
+    rows = conn.execute(f'''
+        SELECT r.machine_id, r.date,
+               IFNULL(d.name,"Водитель удалён"), r.status, r.start_time, r.end_time, IFNULL(c.name,"")
+          FROM records r
+     LEFT JOIN drivers d ON r.driver_id=d.id
+     LEFT JOIN counterparties c ON r.counterparty_id=c.id
+         WHERE {where}
+      ORDER BY r.machine_id, r.date, r.id
+    ''', pr).fetchall()
+
+    grouped = {}
+    for r in rows:
+        grouped.setdefault((r[0], r[1]), []).append(r[2:])
+    return grouped
+
+def get_calendar_month():
+    """Год и месяц из параметров запроса с ограничением диапазона."""
     year = request.args.get('year', type=int, default=datetime.now().year)
     month= request.args.get('month',type=int, default=datetime.now().month)
     if month<1: month=1
     if month>12: month=12
-    if year<2020: year=2020
-    if year>2030: year=2030
-
-    conn = get_db()
-    try:
-        machine = conn.execute("SELECT * FROM machines WHERE id=?", (machine_id,)).fetchone()
-        if not machine:
-            return render_base("<h2>Техника не найдена</h2>"),404
-
-        first_day = datetime(year,month,1)
-        last_day  = (first_day.replace(day=28)+timedelta(days=4)).replace(day=1)-timedelta(days=1)
-        dates = [first_day+timedelta(days=i) for i in range((last_day-first_day).days+1)]
-
-        recs_dict = {}
-        for d in dates:
-            recs = conn.execute('''
-                SELECT IFNULL(d.name,"Водитель удалён"), r.status, r.start_time, r.end_time, IFNULL(c.name,"")
-                  FROM records r
-             LEFT JOIN drivers d ON r.driver_id=d.id
-             LEFT JOIN counterparties c ON r.counterparty_id=c.id
-                 WHERE r.machine_id=? AND r.date=?
-            ''',(machine_id,d.date())).fetchall()
-            recs_dict[d.date()] = recs
-    finally:
-        conn.close()
+    # Только чтобы соседние месяцы оставались допустимыми датами
+    year = min(max(year, MINYEAR+1), MAXYEAR-1)
+    return year, month
 
+def neighbour_months(year, month):
+    """(prev_year, prev_month, next_year, next_month)."""
     prev_month = month-1
     prev_year  = year
     if prev_month<1:
@@ -418,30 +1016,103 @@ def calendar(machine_id):
     if next_month>12:
         next_month=1
         next_year+=1
-
-    # Блок кнопок и заголовка оформляем с отступами
-    calendar_nav = f'''
-    <div class="calendar-header">
-        <div style="flex:1;">
-            <h1 style="margin-bottom:0;">{machine[1]}</h1>
-            <div style="font-size:1rem;color:{COLORS['secondary']};">
-                {first_day.strftime("%B %Y")}
-            </div>
-        </div>
-        <div class="calendar-nav-btns">
-            <a class="btn" href="/calendar/{machine_id}?year={prev_year}&month={prev_month}">
-                ← Пред. месяц
-            </a>
-            <a class="btn" href="/calendar/{machine_id}?year={next_year}&month={next_month}">
-                След. месяц →
-            </a>
-        </div>
-    </div>
+    return prev_year, prev_month, next_year, next_month
+
+# Год/период: ?view=year&year=2025 или ?from=2025-01-01&to=2025-06-30
+app.config['CALENDAR_RANGE_MAX_DAYS'] = 731
+CALENDAR_STATUS_LABELS = {'work':'Работа', 'stop':'Простой', 'repair':'Ремонт', 'holiday':'Выходной'}
+
+def get_calendar_range():
+    """Период вида "год" или "с-по" как (date_from, date_to); None - обычный вид месяца.
+
+    ValueError - неверные даты или период длиннее CALENDAR_RANGE_MAX_DAYS.
+    """
+    if request.args.get('from') or request.args.get('to'):
+        date_from = date.fromisoformat(request.args.get('from',''))
+        date_to = date.fromisoformat(request.args.get('to',''))
+    elif request.args.get('view')=='year':
+        year = request.args.get('year', type=int, default=datetime.now().year)
+        year = min(max(year, MINYEAR+1), MAXYEAR-1)
+        date_from, date_to = date(year,1,1), date(year,12,31)
+    else:
+        return None
+    if date_from>date_to:
+        raise ValueError("начало периода позже конца")
+    if (date_to-date_from).days+1>app.config['CALENDAR_RANGE_MAX_DAYS']:
+        raise ValueError(f"период длиннее {app.config['CALENDAR_RANGE_MAX_DAYS']} дней")
+    return date_from, date_to
+
+def range_months(date_from, date_to):
+    """Месяцы периода: ['YYYY-MM', ...]."""
+    months = []
+    y, m = date_from.year, date_from.month
+    while (y, m)<=(date_to.year, date_to.month):
+        months.append(f"{y:04d}-{m:02d}")
+        y, m = (y+1, 1) if m==12 else (y, m+1)
+    return months
+
+def load_calendar_days(conn, machine_id, date_from, date_to):
+    """Итоги техники по дням одним запросом по idx_records_machine_date.
+
+    Возвращает {'YYYY-MM-DD': {статус: (записей, минут)}} - без имён и комментариев,
+    их отдаёт calendar_day по клику.
+    """
+    days = {}
+    for day, status_, cnt, minutes in conn.execute('''
+        SELECT r.date, r.status, COUNT(*), SUM(r.minutes)
+          FROM records r
+         WHERE r.machine_id=? AND r.date>=? AND r.date<=?
+      GROUP BY r.date, r.status
+    ''', (machine_id, str(date_from), str(date_to))):
+        days.setdefault(day, {})[status_] = (cnt, minutes or 0)
+    return days
+
+def render_calendar_heatmap(machine_id, days, date_from, date_to):
+    """Сетка "месяцы × числа": цвет дня - статус с наибольшим числом минут."""
+    rows = []
+    for month_key in range_months(date_from, date_to):
+        y, m = map(int, month_key.split('-'))
+        cells = []
+        for d in month_dates(y, m):
+            d = d.date()
+            if d<date_from or d>date_to:
+                cells.append('<td class="heat-day heat-out"></td>')
+                continue
+            day_key = str(d)
+            weekend = " heat-weekend" if d.weekday()>=5 else ""
+            statuses = days.get(day_key)
+            if not statuses:
+                cells.append(f'<td class="heat-day{weekend}" data-day="{day_key}" title="{d.strftime("%d.%m.%Y")}"></td>')
+                continue
+            main = max(statuses, key=lambda s_: statuses[s_][1])
+            title_ = d.strftime("%d.%m.%Y")+": "+", ".join(
+                f"{CALENDAR_STATUS_LABELS.get(s_, s_)} {format_minutes(mins)}" for s_, (cnt, mins) in statuses.items())
+            count = sum(cnt for cnt, _ in statuses.values())
+            cells.append(f'<td class="heat-day{weekend}" data-day="{day_key}" title="{title_}" '
+                         f'style="background:{COLORS["status"].get(main,"#fff")};">{count if count>1 else ""}</td>')
+        cells += ['<td class="heat-day heat-out"></td>']*(31-len(month_dates(y, m)))
+        rows.append(f'<tr><th>{datetime(y,m,1).strftime("%m.%Y")}</th>{"".join(cells)}</tr>')
+
+    head = "".join(f"<th>{n}</th>" for n in range(1, 32))
+    legend = "".join(f'<span class="heat-legend" style="background:{COLORS["status"][s_]};">{lbl}</span>'
+                     for s_, lbl in CALENDAR_STATUS_LABELS.items())
+    return f'''
+    <div class="heat-legend-row">{legend}</div>
+    <table class="heat-calendar" data-day-url="/calendar/{machine_id}/day/">
+        <tr><th></th>{head}</tr>
+        {"".join(rows)}
+    </table>
+    <div class="card heat-detail" id="day-detail" hidden></div>
     '''
 
+def render_calendar_grid(conn, machine_id, year, month):
+    """HTML сетки месяца для одной техники (одним запросом к records)."""
+    dates = month_dates(year, month)
+    recs_dict = load_calendar_records(conn, dates[0].date(), dates[-1].date(), machine_id)
+
     cal_html = '<div class="calendar-grid">'
     for d in dates:
-        day_recs = recs_dict.get(d.date(), [])
+        day_recs = recs_dict.get((machine_id, str(d.date())), [])
         inside = ""
         for r in day_recs:
             driver_ = r[0]
@@ -466,6 +1137,124 @@ def calendar(machine_id):
         </div>
         '''
     cal_html+='</div>'
+    return cal_html
+
+# Кэш готовых сеток: (БД, техника, месяц) -> (версии, html), LRU
+app.config['CALENDAR_CACHE_SIZE'] = 512
+# Дополнительно хранить сетки в таблице calendar_cache - общий кэш всех воркеров
+app.config['CALENDAR_SHARED_CACHE'] = True
+_calendar_cache = OrderedDict()
+_calendar_cache_lock = threading.Lock()
+
+def migrate_calendar_cache(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS calendar_cache (
+            machine_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            versions TEXT NOT NULL,
+            html TEXT NOT NULL,
+            PRIMARY KEY (machine_id, month)
+        ) WITHOUT ROWID
+    ''')
+
+def store_shared_calendar(machine_id, month_key, versions, html):
+    """Запись сетки в calendar_cache без ожидания блокировки.
+
+    Отдельное соединение с busy_timeout=0: если БД сейчас пишет другой процесс
+    (например, импорт), кэш просто не пополняется, а чтение календаря не ждёт.
+    """
+    conn = connect_db()
+    try:
+        conn.execute("PRAGMA busy_timeout = 0")
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO calendar_cache (machine_id, month, versions, html) VALUES (?,?,?,?)",
+                (machine_id, month_key, versions, html))
+    except sqlite3.OperationalError:
+        pass
+    finally:
+        conn.close()
+
+def cached_calendar_grid(conn, machine_id, year, month):
+    """Сетка месяца из кэша; пересобирается, только если изменились её версии данных.
+
+    Версии - записи этой техники за этот месяц, водители и контрагенты
+    (их имена выводятся в сетке), см. migrate_records_versions.
+    """
+    month_key = f"{year:04d}-{month:02d}"
+    versions = ",".join(map(str, get_data_versions(
+        conn, ['drivers', 'counterparties', f'records:m{machine_id}:{month_key}'])))
+    key = (app.config['DATABASE'], machine_id, month_key)
+    with _calendar_cache_lock:
+        hit = _calendar_cache.get(key)
+        if hit and hit[0]==versions:
+            _calendar_cache.move_to_end(key)
+            return hit[1]
+
+    html = None
+    shared = app.config['CALENDAR_SHARED_CACHE']
+    if shared:
+        row = conn.execute(
+            "SELECT html FROM calendar_cache WHERE machine_id=? AND month=? AND versions=?",
+            (machine_id, month_key, versions)
+        ).fetchone()
+        html = row[0] if row else None
+    if html is None:
+        html = render_calendar_grid(conn, machine_id, year, month)
+        if shared:
+            store_shared_calendar(machine_id, month_key, versions, html)
+
+    with _calendar_cache_lock:
+        _calendar_cache[key] = (versions, html)
+        _calendar_cache.move_to_end(key)
+        while len(_calendar_cache)>app.config['CALENDAR_CACHE_SIZE']:
+            _calendar_cache.popitem(last=False)
+    return html
+
+@app.route('/calendar/<int:machine_id>')
+@etag_by_versions(_calendar_versions)
+def calendar(machine_id):
+    conn = get_db()
+    machine = conn.execute("SELECT * FROM machines WHERE id=?", (machine_id,)).fetchone()
+    if not machine:
+        return render_base("<h2>Техника не найдена</h2>"),404
+
+    try:
+        period = get_calendar_range()
+    except ValueError as e:
+        return render_base(f"<h2>Неверный период: {escape(str(e))}</h2>"),400
+    if period:
+        return calendar_period(conn, machine, *period)
+
+    year, month = get_calendar_month()
+    first_day = datetime(year,month,1)
+
+    prev_year, prev_month, next_year, next_month = neighbour_months(year, month)
+
+    # Блок кнопок и заголовка оформляем с отступами
+    calendar_nav = f'''
+    <div class="calendar-header">
+        <div style="flex:1;">
+            <h1 style="margin-bottom:0;">{machine[1]}</h1>
+            <div style="font-size:1rem;color:{COLORS['secondary']};">
+                {first_day.strftime("%B %Y")}
+            </div>
+        </div>
+        <div class="calendar-nav-btns">
+            <a class="btn" href="/calendar/{machine_id}?year={prev_year}&month={prev_month}">
+                ← Пред. месяц
+            </a>
+            <a class="btn" href="/calendar/{machine_id}?year={next_year}&month={next_month}">
+                След. месяц →
+            </a>
+            <a class="btn" href="/calendar/{machine_id}?view=year&year={year}">
+                Весь год
+            </a>
+        </div>
+    </div>
+    '''
+
+    cal_html = cached_calendar_grid(conn, machine_id, year, month)
 
     return render_base(f'''
         <a href="/" class="btn back-btn">← Назад</a>
@@ -475,6 +1264,145 @@ def calendar(machine_id):
         </div>
     ''')
 
+def calendar_period(conn, machine, date_from, date_to):
+    """Год или произвольный период одной техники: тепловая карта, подробности дня - по клику."""
+    machine_id = machine[0]
+    days = load_calendar_days(conn, machine_id, date_from, date_to)
+
+    if request.args.get('view')=='year' and not request.args.get('from'):
+        y = date_from.year
+        title_ = f"{y} год"
+        nav_links = f'''
+            <a class="btn" href="/calendar/{machine_id}?view=year&year={y-1}">← {y-1}</a>
+            <a class="btn" href="/calendar/{machine_id}?view=year&year={y+1}">{y+1} →</a>
+        '''
+    else:
+        title_ = f"{date_from.strftime('%d.%m.%Y')} - {date_to.strftime('%d.%m.%Y')}"
+        nav_links = ""
+
+    calendar_nav = f'''
+    <div class="calendar-header">
+        <div style="flex:1;">
+            <h1 style="margin-bottom:0;">{machine[1]}</h1>
+            <div style="font-size:1rem;color:{COLORS['secondary']};">{title_}</div>
+        </div>
+        <div class="calendar-nav-btns">
+            {nav_links}
+            <a class="btn" href="/calendar/{machine_id}?year={date_from.year}&month={date_from.month}">Месяц</a>
+        </div>
+        <form method="GET" class="calendar-nav-btns">
+            <input type="date" name="from" value="{date_from}" required>
+            <input type="date" name="to" value="{date_to}" required>
+            <button type="submit" class="btn">Показать</button>
+        </form>
+    </div>
+    '''
+
+    return render_base(f'''
+        <a href="/" class="btn back-btn">← Назад</a>
+        <div class="card" style="margin-top:1rem;overflow-x:auto;">
+            {calendar_nav}
+            {render_calendar_heatmap(machine_id, days, date_from, date_to)}
+        </div>
+    ''')
+
+@app.route('/calendar/<int:machine_id>/day/<day>')
+@etag_by_versions(_calendar_day_versions)
+def calendar_day(machine_id, day):
+    """Записи одного дня фрагментом HTML - подгружается по клику в сетке периода."""
+    try:
+        day_ = date.fromisoformat(day)
+    except ValueError:
+        return "Неверная дата", 400
+    conn = get_db()
+    rows = conn.execute('''
+        SELECT IFNULL(d.name,"Водитель удалён"), r.status, r.start_time, r.end_time, r.minutes,
+               IFNULL(c.name,""), IFNULL(r.comment,"")
+          FROM records r
+     LEFT JOIN drivers d ON r.driver_id=d.id
+     LEFT JOIN counterparties c ON r.counterparty_id=c.id
+         WHERE r.machine_id=? AND r.date=?
+      ORDER BY r.start_time, r.id
+    ''', (machine_id, str(day_))).fetchall()
+
+    items = ""
+    for driver_, status_, st, en, minutes, cparty_, comment_ in rows:
+        items += f'''
+        <div class="status" style="background:{COLORS['status'].get(status_,"#fff")};margin-bottom:0.5rem;">
+            {escape(driver_)} - {CALENDAR_STATUS_LABELS.get(status_, status_)}
+            {f"<br>{st} - {en} ({format_minutes(minutes)})" if st and en else ""}
+            {f"<br>{escape(cparty_)}" if cparty_ else ""}
+            {f"<br><i>{escape(comment_)}</i>" if comment_ else ""}
+        </div>
+        '''
+    return f'''
+        <h3>{day_.strftime("%d.%m.%Y")}</h3>
+        {items or "<p>Записей нет</p>"}
+    '''
+
+@app.route('/calendar')
+@etag_by_versions(_fleet_calendar_versions)
+def fleet_calendar():
+    """Календарь всего парка: техника × дни месяца, одним запросом."""
+    year, month = get_calendar_month()
+    dates = month_dates(year, month)
+
+    conn = get_db()
+    machines = get_ref_data(conn)['machines']['rows']
+    recs_dict = load_calendar_records(conn, dates[0].date(), dates[-1].date())
+
+    prev_year, prev_month, next_year, next_month = neighbour_months(year, month)
+
+    calendar_nav = f'''
+    <div class="calendar-header">
+        <div style="flex:1;">
+            <h1 style="margin-bottom:0;">Календарь техники</h1>
+            <div style="font-size:1rem;color:{COLORS['secondary']};">
+                {dates[0].strftime("%B %Y")}
+            </div>
+        </div>
+        <div class="calendar-nav-btns">
+            <a class="btn" href="/calendar?year={prev_year}&month={prev_month}">
+                ← Пред. месяц
+            </a>
+            <a class="btn" href="/calendar?year={next_year}&month={next_month}">
+                След. месяц →
+            </a>
+        </div>
+    </div>
+    '''
+
+    head = "".join(f'<th class="fleet-day">{d.strftime("%d")}</th>' for d in dates)
+    rows = []
+    for m in machines:
+        cells = []
+        for d in dates:
+            day_recs = recs_dict.get((m[0], str(d.date())), [])
+            if not day_recs:
+                cells.append('<td class="fleet-day"></td>')
+                continue
+            # Цвет ячейки - по первой записи, подробности во всплывающей подсказке
+            color_ = COLORS['status'].get(day_recs[0][1],"#fff")
+            title_ = "; ".join(f"{r[0]} - {r[1]}" + (f" {r[2]}-{r[3]}" if r[2] and r[3] else "") for r in day_recs)
+            cells.append(f'<td class="fleet-day" style="background:{color_};" title="{title_}">{len(day_recs)}</td>')
+        rows.append(f'''
+        <tr>
+            <td><a href="/calendar/{m[0]}?year={year}&month={month}">{m[1]}</a></td>
+            {"".join(cells)}
+        </tr>
+        ''')
+
+    return render_base(f'''
+        <a href="/" class="btn back-btn">← Назад</a>
+        <div class="card" style="margin-top:1rem;overflow-x:auto;">
+            {calendar_nav}
+            <table class="fleet-calendar">
+                <tr><th>Техника</th>{head}</tr>
+                {"".join(rows)}
+            </table>
+        </div>
+    ''')
+
 # --------------------- АДМИНКА ---------------------
 
 @app.route('/admin')
@@ -487,6 +1415,10 @@ def admin():
                 <a class="btn" href="/admin/drivers">&#128100; Водители</a>
                 <a class="btn" href="/admin/counterparties">&#127970; Контрагенты</a>
                 <a class="btn" href="/admin/records">&#128197; Записи</a>
+                <a class="btn" href="/admin/records/import">&#128229; Импорт записей</a>
+                <a class="btn" href="/reports/monthly">&#128200; Часы по месяцам</a>
+                <a class="btn" href="/reports/utilization">&#128201; Загрузка техники</a>
+                <a class="btn" href="/reports/conflicts">&#9888; Пересечения записей</a>
             </div>
         </div>
     ''')
@@ -494,16 +1426,14 @@ def admin():
 # --------------------- МАШИНЫ ---------------------
 
 @app.route('/admin/machines', methods=['GET','POST'])
+@etag_by_versions(lambda: ['machines'])
 def admin_machines():
     if request.method=='POST':
         insert_machine(request.form['name'])
         return redirect('/admin/machines')
 
     conn = get_db()
-    try:
-        machines = conn.execute("SELECT * FROM machines ORDER BY id").fetchall()
-    finally:
-        conn.close()
+    machines = conn.execute("SELECT * FROM machines ORDER BY id").fetchall()
 
     rows = ""
     for m in machines:
@@ -547,12 +1477,9 @@ def edit_machine(id):
             conn.commit()
         except:
             conn.rollback()
-        finally:
-            conn.close()
         return redirect('/admin/machines')
     else:
         machine = conn.execute("SELECT * FROM machines WHERE id=?", (id,)).fetchone()
-        conn.close()
         if not machine:
             return render_base("<h2>Машина не найдена</h2>"),404
         return render_base(f'''
@@ -575,23 +1502,19 @@ def delete_machine(id):
     except:
         conn.rollback()
         return "Ошибка удаления",500
-    finally:
-        conn.close()
     return redirect('/admin/machines')
 
 # --------------------- ВОДИТЕЛИ ---------------------
 
 @app.route('/admin/drivers', methods=['GET','POST'])
+@etag_by_versions(lambda: ['drivers'])
 def admin_drivers():
     if request.method=='POST':
         insert_driver(request.form['name'])
         return redirect('/admin/drivers')
 
     conn = get_db()
-    try:
-        drivers = conn.execute("SELECT * FROM drivers ORDER BY id").fetchall()
-    finally:
-        conn.close()
+    drivers = conn.execute("SELECT * FROM drivers ORDER BY id").fetchall()
 
     rows=""
     for d in drivers:
@@ -635,12 +1558,9 @@ def edit_driver(id):
             conn.commit()
         except:
             conn.rollback()
-        finally:
-            conn.close()
         return redirect('/admin/drivers')
     else:
         driver = conn.execute("SELECT * FROM drivers WHERE id=?", (id,)).fetchone()
-        conn.close()
         if not driver:
             return render_base("<h2>Водитель не найден</h2>"),404
         return render_base(f'''
@@ -663,23 +1583,19 @@ def delete_driver(id):
     except:
         conn.rollback()
         return "Ошибка удаления",500
-    finally:
-        conn.close()
     return redirect('/admin/drivers')
 
 # --------------------- КОНТРАГЕНТЫ ---------------------
 
 @app.route('/admin/counterparties', methods=['GET','POST'])
+@etag_by_versions(lambda: ['counterparties'])
 def admin_counterparties():
     if request.method=='POST':
         insert_counterparty(request.form['name'])
         return redirect('/admin/counterparties')
 
     conn = get_db()
-    try:
-        cparties = conn.execute("SELECT * FROM counterparties ORDER BY id").fetchall()
-    finally:
-        conn.close()
+    cparties = conn.execute("SELECT * FROM counterparties ORDER BY id").fetchall()
 
     rows=""
     for cp in cparties:
@@ -723,12 +1639,9 @@ def edit_counterparty(id):
             conn.commit()
         except:
             conn.rollback()
-        finally:
-            conn.close()
         return redirect('/admin/counterparties')
     else:
         cp = conn.execute("SELECT * FROM counterparties WHERE id=?", (id,)).fetchone()
-        conn.close()
         if not cp:
             return render_base("<h2>Контрагент не найден</h2>"),404
         return render_base(f'''
@@ -751,142 +1664,568 @@ def delete_counterparty(id):
     except:
         conn.rollback()
         return "Ошибка удаления",500
-    finally:
-        conn.close()
     return redirect('/admin/counterparties')
 
-# --------------------- ЗАПИСИ (СПРАВА - ФИЛЬТРЫ), ПРИ ЭТОМ ОФОРМЛЕНИЕ ОПРЯТНОЕ ---------------------
+# --------------------- ФИЛЬТРЫ ЗАПИСЕЙ ---------------------
 
-@app.route('/admin/records', methods=['GET','POST'])
-def admin_records():
-    if request.method=='POST':
-        # Добавить запись
-        date_str = request.form['date']
-        machine_id=int(request.form['machine_id'])
-        driver_id =int(request.form['driver_id'])
-        status= request.form['status']
-        start_t= request.form.get('start_time','')
-        end_t  = request.form.get('end_time','')
-        comm   = request.form.get('comment','')
-        c_id   = request.form.get('counterparty_id')
-        cpar_id= int(c_id) if c_id else None
+RECORD_STATUSES = ("work","stop","repair","holiday")
 
-        hours=0
-        if start_t and end_t:
-            try:
-                st=datetime.strptime(start_t,'%H:%M')
-                en=datetime.strptime(end_t,'%H:%M')
-                if en<st: en+=timedelta(days=1)
-                hours=(en-st).seconds//3600
-            except:
-                pass
-
-        insert_record(date_str,machine_id,driver_id,status,start_t or None,end_t or None,hours,comm,cpar_id)
-        return redirect('/admin/records')
+# Ключи сортировки: (выражение, направление). Последним всегда r.id, чтобы
+# порядок был однозначным - на этом держится постраничный вывод по курсору.
+RECORDS_SORT_COLUMNS = {
+    'date_asc':    [("r.date","ASC"), ("r.id","ASC")],
+    'date_desc':   [("r.date","DESC"), ("r.id","DESC")],
+    'hours_asc':   [("r.minutes","ASC"), ("r.date","ASC"), ("r.id","ASC")],
+    'hours_desc':  [("r.minutes","DESC"), ("r.date","DESC"), ("r.id","DESC")],
+    'machine_asc': [("IFNULL(m.name,'')","ASC"), ("r.date","DESC"), ("r.id","DESC")],
+    'driver_asc':  [("IFNULL(d.name,'')","ASC"), ("r.date","DESC"), ("r.id","DESC")],
+}
 
-    # GET
-    # Фильтры
-    date_from=request.args.get('date_from','')
-    date_to=  request.args.get('date_to','')
-    mach_f=  request.args.get('mach', type=int)
-    driv_f=  request.args.get('driv', type=int)
-    cpar_f=  request.args.get('cpar', type=int)
-    stat_f=  request.args.get('status','')
-    comm_sub=request.args.get('comment_sub','').strip()
-    sort_key=request.args.get('sort','date_desc')
-    page=    request.args.get('page', type=int, default=1)
-    if page<1: page=1
+RECORDS_ORDER_SQL = {
+    key: "ORDER BY "+", ".join(f"{expr} {direction}" for expr, direction in cols)
+    for key, cols in RECORDS_SORT_COLUMNS.items()
+}
+
+def get_records_filters(args):
+    """Фильтры списка записей из параметров запроса (общие для /admin/records и /export)."""
+    return {
+        'date_from':   args.get('date_from',''),
+        'date_to':     args.get('date_to',''),
+        'mach':        args.get('mach', type=int),
+        'driv':        args.get('driv', type=int),
+        'cpar':        args.get('cpar', type=int),
+        'status':      args.get('status',''),
+        'comment_sub': args.get('comment_sub','').strip(),
+        'sort':        args.get('sort','date_desc'),
+    }
 
+def comment_fts_query(text):
+    """Строка поиска -> запрос FTS5: каждое слово ищется по префиксу, все слова обязательны."""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{w}"*' for w in words)
+
+def build_records_where(filters):
+    """WHERE-часть и параметры для таблицы records (алиас r)."""
     where=[]
     pr=[]
-    if date_from:
+    if filters.get('date_from'):
         where.append("r.date>=?")
-        pr.append(date_from)
-    if date_to:
+        pr.append(filters['date_from'])
+    if filters.get('date_to'):
         where.append("r.date<=?")
-        pr.append(date_to)
-    if mach_f:
+        pr.append(filters['date_to'])
+    if filters.get('mach'):
         where.append("r.machine_id=?")
-        pr.append(mach_f)
-    if driv_f:
+        pr.append(filters['mach'])
+    if filters.get('driv'):
         where.append("r.driver_id=?")
-        pr.append(driv_f)
-    if cpar_f:
+        pr.append(filters['driv'])
+    if filters.get('cpar'):
         where.append("r.counterparty_id=?")
-        pr.append(cpar_f)
-    if stat_f in ("work","stop","repair","holiday"):
+        pr.append(filters['cpar'])
+    if filters.get('status') in RECORD_STATUSES:
         where.append("r.status=?")
-        pr.append(stat_f)
-    if comm_sub:
-        where.append("r.comment LIKE ?")
-        pr.append(f"%{comm_sub}%")
+        pr.append(filters['status'])
+    if filters.get('comment_sub'):
+        fts_query = comment_fts_query(filters['comment_sub'])
+        if app.config['COMMENT_FTS'] and fts_query:
+            where.append("r.id IN (SELECT rowid FROM records_fts WHERE records_fts MATCH ?)")
+            pr.append(fts_query)
+        else:
+            where.append("r.comment LIKE ?")
+            pr.append(f"%{filters['comment_sub']}%")
 
     where_sql=""
     if where:
         where_sql="WHERE "+ " AND ".join(where)
+    return where_sql, pr
 
-    # Сортировка
-    if sort_key=="date_asc":
-        order_sql="ORDER BY r.date ASC, r.id ASC"
-    elif sort_key=="date_desc":
-        order_sql="ORDER BY r.date DESC, r.id DESC"
-    elif sort_key=="hours_asc":
-        order_sql="ORDER BY r.hours ASC, r.date ASC"
-    elif sort_key=="hours_desc":
-        order_sql="ORDER BY r.hours DESC, r.date DESC"
-    elif sort_key=="machine_asc":
-        order_sql="ORDER BY m.name ASC, r.date DESC"
-    elif sort_key=="driver_asc":
-        order_sql="ORDER BY d.name ASC, r.date DESC"
-    else:
-        order_sql="ORDER BY r.date DESC, r.id DESC"
+def records_order_sql(sort_key):
+    return RECORDS_ORDER_SQL.get(sort_key, RECORDS_ORDER_SQL['date_desc'])
 
-    conn = get_db()
-    # Для пагинации
-    count_sql=f'''
-        SELECT COUNT(*)
+def records_sort_columns(sort_key):
+    return RECORDS_SORT_COLUMNS.get(sort_key, RECORDS_SORT_COLUMNS['date_desc'])
+
+# --------------------- ПОСТРАНИЧНЫЙ ВЫВОД ПО КУРСОРУ ---------------------
+
+app.config['RECORDS_PER_PAGE'] = 10       # Записей на странице по умолчанию
+app.config['RECORDS_EXACT_COUNT'] = True   # Показывать общее число записей
+app.config['RECORDS_COUNT_TTL'] = 30       # Сколько секунд кэшировать COUNT(*) по фильтру
+
+RECORDS_FROM_SQL = '''
           FROM records r
      LEFT JOIN machines m ON r.machine_id=m.id
      LEFT JOIN drivers d ON r.driver_id=d.id
-     LEFT JOIN counterparties c ON r.counterparty_id=c.id
+     LEFT JOIN counterparties c ON r.counterparty_id=c.id'''
+
+records_cursor_serializer = URLSafeSerializer(app.secret_key, salt='records-cursor')
+_records_count_cache = {}
+
+RECORDS_PAGE_SIZES = (10, 25, 50, 100, 500)   # Варианты ?per_page=; "all" - все записи для печати
+
+def records_page_size(args):
+    """Размер страницы из ?per_page=; None - режим печати (все записи одним потоком)."""
+    value = args.get('per_page', '')
+    if value=='all':
+        return None
+    size = args.get('per_page', type=int)
+    return size if size in RECORDS_PAGE_SIZES else app.config['RECORDS_PER_PAGE']
+
+def encode_records_cursor(sort_key, values):
+    return records_cursor_serializer.dumps([sort_key, list(values)])
+
+def decode_records_cursor(token, sort_key):
+    """Значения ключа сортировки из токена или None, если токен чужой/испорчен."""
+    if not token:
+        return None
+    try:
+        token_sort, values = records_cursor_serializer.loads(token)
+    except BadSignature:
+        return None
+    if token_sort!=sort_key or len(values)!=len(records_sort_columns(sort_key)):
+        return None
+    return values
+
+def keyset_condition(columns, values, backward=False):
+    """Условие "строго после values" в порядке columns ("до", если backward)."""
+    ops = []
+    for _, direction in columns:
+        forward = direction=="ASC"
+        ops.append(">" if forward!=backward else "<")
+    if len(set(ops))==1:
+        # Одно направление - сравнение кортежей, его SQLite ведёт по индексу
+        exprs = ", ".join(expr for expr, _ in columns)
+        marks = ", ".join("?" for _ in columns)
+        return f"({exprs}) {ops[0]} ({marks})", list(values)
+    parts=[]
+    pr=[]
+    for i, (expr, _) in enumerate(columns):
+        conds = [f"{columns[j][0]}=?" for j in range(i)] + [f"{expr}{ops[i]}?"]
+        parts.append("("+" AND ".join(conds)+")")
+        pr.extend(values[:i+1])
+    return "("+" OR ".join(parts)+")", pr
+
+def fetch_records_page(conn, columns_sql, filters, limit, after=None, before=None):
+    """Страница записей по курсору вместо LIMIT/OFFSET.
+
+    columns_sql - список столбцов SELECT (алиасы r, m, d, c как в RECORDS_FROM_SQL).
+    Возвращает (строки, токен следующей страницы, токен предыдущей).
+    """
+    sort_key = filters['sort'] if filters['sort'] in RECORDS_SORT_COLUMNS else 'date_desc'
+    columns = records_sort_columns(sort_key)
+    where_sql, pr = build_records_where(filters)
+
+    after_vals = decode_records_cursor(after, sort_key)
+    before_vals = None if after_vals is not None else decode_records_cursor(before, sort_key)
+    backward = before_vals is not None
+    cursor_vals = before_vals if backward else after_vals
+    if cursor_vals is not None:
+        cond, cond_pr = keyset_condition(columns, cursor_vals, backward)
+        where_sql = (where_sql+" AND " if where_sql else "WHERE ")+cond
+        pr = pr+cond_pr
+
+    order = ", ".join(
+        f"{expr} {('DESC' if direction=='ASC' else 'ASC') if backward else direction}"
+        for expr, direction in columns
+    )
+    keys = ", ".join(expr for expr, _ in columns)
+    rows = conn.execute(f'''
+        SELECT {columns_sql},
+               {keys}
+        {RECORDS_FROM_SQL}
         {where_sql}
-    '''
-    total_count=conn.execute(count_sql, pr).fetchone()[0]
-    total_pages=(total_count+RECORDS_PER_PAGE-1)//RECORDS_PER_PAGE
-    offset=(page-1)*RECORDS_PER_PAGE
+        ORDER BY {order}
+        LIMIT ?
+    ''', pr+[limit+1]).fetchall()
+
+    more = len(rows)>limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    n = len(columns)
+    next_token = prev_token = None
+    if rows:
+        if more or backward:
+            next_token = encode_records_cursor(sort_key, rows[-1][-n:])
+        if (more and backward) or (not backward and cursor_vals is not None):
+            prev_token = encode_records_cursor(sort_key, rows[0][-n:])
+    return [r[:-n] for r in rows], next_token, prev_token
+
+def iter_records(conn, columns_sql, filters):
+    """Все записи по фильтру в порядке сортировки, порциями из курсора."""
+    where_sql, pr = build_records_where(filters)
+    return iter_rows(conn.execute(f'''
+        SELECT {columns_sql}
+        {RECORDS_FROM_SQL}
+        {where_sql}
+        {records_order_sql(filters['sort'])}
+    ''', pr))
+
+def count_records(conn, where_sql, pr):
+    """COUNT(*) по фильтру с кэшем на RECORDS_COUNT_TTL секунд; None, если счёт выключен.
+
+    В ключе - версия records: после любой записи счёт пересчитывается сразу.
+    """
+    if not app.config['RECORDS_EXACT_COUNT']:
+        return None
+    key = (app.config['DATABASE'], get_data_versions(conn, ['records'])[0], where_sql, tuple(pr))
+    hit = _records_count_cache.get(key)
+    now = time.monotonic()
+    if hit and hit[0]>now:
+        return hit[1]
+    total = conn.execute(f"SELECT COUNT(*) {RECORDS_FROM_SQL} {where_sql}", pr).fetchone()[0]
+    if len(_records_count_cache)>=256:
+        _records_count_cache.clear()
+    _records_count_cache[key] = (now+app.config['RECORDS_COUNT_TTL'], total)
+    return total
+
+# Пути фильтрации, которые должны обслуживаться индексом (см. DB_INDEXES)
+INDEX_CHECK_PATHS = [
+    ("Период дат",        {'date_from':'2024-01-01','date_to':'2024-12-31','sort':'date_desc'}),
+    ("Техника",           {'mach':1,'sort':'date_desc'}),
+    ("Календарь техники", {'mach':1,'date_from':'2024-01-01','date_to':'2024-01-31','sort':'date_asc'}),
+    ("Водитель",          {'driv':1,'sort':'date_desc'}),
+    ("Контрагент",        {'cpar':1,'sort':'date_desc'}),
+    ("Статус",            {'status':'repair','sort':'date_desc'}),
+    ("Комментарий",       {'comment_sub':'ремонт гидр','sort':'date_desc'}),
+    ("Часы по возр.",     {'sort':'hours_asc'}),
+    ("Часы по убыв.",     {'sort':'hours_desc'}),
+    ("Экспорт (все)",     {'sort':'date_asc'}),
+]
+
+def check_index_usage(conn):
+    """EXPLAIN QUERY PLAN для каждого пути из INDEX_CHECK_PATHS.
+
+    Возвращает список (название, [строки плана], использует_индекс).
+    """
+    result=[]
+    for label, filters in INDEX_CHECK_PATHS:
+        where_sql, pr = build_records_where(filters)
+        plan = conn.execute(f'''
+            EXPLAIN QUERY PLAN
+            SELECT r.*, m.name, d.name, c.name
+              FROM records r
+         LEFT JOIN machines m ON r.machine_id=m.id
+         LEFT JOIN drivers d ON r.driver_id=d.id
+         LEFT JOIN counterparties c ON r.counterparty_id=c.id
+            {where_sql}
+            {records_order_sql(filters.get('sort'))}
+        ''', pr).fetchall()
+        details=[row[3] for row in plan]
+        uses_index=any(d.startswith(("SEARCH r ","SCAN r USING")) for d in details)
+        result.append((label, details, uses_index))
+    return result
+
+@app.cli.command('check-indexes')
+def check_indexes_command():
+    """Проверка планов запросов: flask --app app check-indexes"""
+    conn = get_db()
+    report = check_index_usage(conn)
+    failed = 0
+    for label, details, uses_index in report:
+        print(f"[{'OK' if uses_index else 'SCAN'}] {label}")
+        for d in details:
+            print(f"      {d}")
+        if not uses_index:
+            failed += 1
+    if failed:
+        raise SystemExit(1)
+
+# --------------------- ПЕРЕСЕЧЕНИЯ ПО ВРЕМЕНИ ---------------------
+
+# Одна техника или один водитель не могут быть в двух записях одновременно.
+# Смена длится меньше суток, поэтому пересечься с записью за день D могут
+# только записи за D-1..D+1 - их берём по индексам (machine_id, date) и (driver_id, date).
+OVERLAP_KINDS = (('machine_id', 'Техника'), ('driver_id', 'Водитель'))
+
+def record_interval(date_str, start_t, minutes):
+    """(начало, конец) записи в минутах от начала эпохи date.toordinal()."""
+    day = datetime.strptime(date_str, '%Y-%m-%d').toordinal()
+    # Время разбирается как в calc_minutes: "7:30" допустимо наравне с "07:30"
+    st = datetime.strptime(start_t, '%H:%M')
+    start = day*1440+st.hour*60+st.minute
+    return start, start+minutes
+
+def find_overlaps(conn, date_str, start_t, end_t, machine_id, driver_id, exclude_id=None):
+    """Записи той же техники или того же водителя, пересекающиеся по времени.
+
+    Список (вид, строка), строка - (id, date, start_time, end_time, техника, водитель).
+    """
+    minutes = calc_minutes(start_t, end_t)
+    if not minutes:
+        return []
+    lo, hi = record_interval(date_str, start_t, minutes)
+    day = datetime.strptime(date_str, '%Y-%m-%d').date()
+    days = (str(day-timedelta(days=1)), str(day+timedelta(days=1)))
+    found = []
+    for (column, label), value in zip(OVERLAP_KINDS, (machine_id, driver_id)):
+        if value is None:
+            continue
+        rows = conn.execute(f'''
+            SELECT r.id, r.date, r.start_time, r.end_time, r.minutes,
+                   IFNULL(m.name,'-'), IFNULL(d.name,'-')
+            {RECORDS_FROM_SQL}
+             WHERE r.{column}=? AND r.date BETWEEN ? AND ? AND r.minutes>0 AND r.id IS NOT ?
+        ''', (value, *days, exclude_id)).fetchall()
+        for r in rows:
+            start, end = record_interval(r[1], r[2], r[4])
+            if start<hi and lo<end:
+                found.append((label, r[:4]+r[5:]))
+    return found
+
+def record_form_times(form):
+    """(date, start_time, end_time) из формы записи в виде YYYY-MM-DD и HH:MM.
+
+    Проверяется до BEGIN IMMEDIATE: неверная дата или время - ValueError с текстом
+    для пользователя, а не 500 под блокировкой записи.
+    """
+    return (_import_date(form.get('date')),
+            _import_time(form.get('start_time')),
+            _import_time(form.get('end_time')))
+
+def record_form_error(error):
+    return render_base(f'''
+        <div class="card">
+            <h2>Запись не сохранена</h2>
+            <p>{escape(str(error))}</p>
+            <a class="btn" href="javascript:history.back()">Исправить</a>
+        </div>
+    '''),400
+
+def overlap_page(conflicts, action):
+    """Страница "есть пересечения": сохранить всё равно (allow_overlap=1) или вернуться."""
+    rows = "".join(
+        f'''<tr><td>{label}</td><td>{format_date(r[1])}</td><td>{r[2]} - {r[3]}</td>
+            <td>{escape(r[4])}</td><td>{escape(r[5])}</td>
+            <td><a class="btn" href="/edit/record/{r[0]}">Открыть</a></td></tr>'''
+        for label, r in conflicts
+    )
+    hidden = "".join(
+        f'<input type="hidden" name="{escape(k)}" value="{escape(v)}">'
+        for k, v in request.form.items() if k!='allow_overlap'
+    )
+    return render_base(f'''
+        <div class="card">
+            <h1>Пересечение по времени</h1>
+            <p>В это время уже есть записи с той же техникой или тем же водителем:</p>
+            <table>
+                <tr><th>Совпадает</th><th>Дата</th><th>Время</th><th>Техника</th><th>Водитель</th><th></th></tr>
+                {rows}
+            </table>
+            <form method="POST" action="{action}" style="margin-top:1rem;">
+                {hidden}
+                <input type="hidden" name="allow_overlap" value="1">
+                <button type="submit" class="btn btn-danger">Сохранить всё равно</button>
+                <a class="btn" href="javascript:history.back()">Исправить</a>
+            </form>
+        </div>
+    '''), 409
+
+def sweep_overlaps(conn):
+    """Все пересечения в таблице за один проход по записям, отсортированным по началу.
+
+    Для каждой техники/водителя держим записи, которые ещё не закончились к началу
+    текущей; каждая из них пересекается с текущей. Возвращает список
+    (вид, id техники/водителя, запись A, запись B, минут пересечения).
+    """
+    cur = conn.execute('''
+        SELECT id, date, start_time, minutes, machine_id, driver_id
+          FROM records
+         WHERE minutes>0 AND start_time IS NOT NULL
+         ORDER BY date
+    ''')
 
-    query=f'''
-        SELECT r.id,
+    def by_start():
+        # Внутри дня - по разобранному началу: строка start_time может быть без ведущего нуля
+        for _, day_rows in groupby(iter_rows(cur), key=lambda r: r[1]):
+            yield from sorted((record_interval(r[1], r[2], r[3]), r[0], r[4], r[5]) for r in day_rows)
+
+    active = [{}, {}]   # по OVERLAP_KINDS: ключ -> [(конец, id), ...]
+    found = []
+    for (start, end), rec_id, machine_id, driver_id in by_start():
+        for kind, key in enumerate((machine_id, driver_id)):
+            if key is None:
+                continue
+            running = [(e, other) for e, other in active[kind].get(key, ()) if e>start]
+            for other_end, other_id in running:
+                found.append((OVERLAP_KINDS[kind][0], key, other_id, rec_id, min(end, other_end)-start))
+            running.append((end, rec_id))
+            active[kind][key] = running
+    return found
+
+@app.route('/reports/conflicts')
+@etag_by_versions(lambda: ['records', 'machines', 'drivers'])
+def report_conflicts():
+    """Все пересечения записей по технике и водителям; ?format=json"""
+    conn = get_db()
+    found = sweep_overlaps(conn)
+    ids = sorted({i for f in found for i in f[2:4]})
+    details = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start+500]
+        for row in conn.execute(f'''
+            SELECT r.id, r.date, r.start_time, r.end_time, IFNULL(m.name,'-'), IFNULL(d.name,'-')
+            {RECORDS_FROM_SQL}
+             WHERE r.id IN ({",".join("?"*len(chunk))})
+        ''', chunk):
+            details[row[0]] = row
+    labels = dict(OVERLAP_KINDS)
+
+    if request.args.get('format')=='json':
+        def rec(i):
+            return dict(zip(("id","date","start_time","end_time","machine","driver"), details[i]))
+        return jsonify([
+            {"kind": kind.removesuffix("_id"), "id": key, "a": rec(a), "b": rec(b), "overlap_minutes": m}
+            for kind, key, a, b, m in found
+        ])
+
+    def rec_html(i):
+        r = details[i]
+        return f'<a href="/edit/record/{i}">{format_date(r[1])} {r[2]}-{r[3]}</a>'
+    rows = "".join(
+        f'''<tr><td>{labels[kind]}</td>
+            <td>{escape(details[a][4] if kind=="machine_id" else details[a][5])}</td>
+            <td>{rec_html(a)}<br><small>{escape(details[a][5] if kind=="machine_id" else details[a][4])}</small></td>
+            <td>{rec_html(b)}<br><small>{escape(details[b][5] if kind=="machine_id" else details[b][4])}</small></td>
+            <td>{format_minutes(m)}</td></tr>'''
+        for kind, key, a, b, m in found
+    )
+    return render_base(f'''
+        <a href="/admin" class="btn back-btn">← Назад</a>
+        <div class="card">
+            <h1>Пересечения записей</h1>
+            <p>Найдено: {len(found)}</p>
+            <table>
+                <tr><th>Совпадает</th><th>Кто</th><th>Запись 1</th><th>Запись 2</th><th>Пересечение</th></tr>
+                {rows}
+            </table>
+        </div>
+    ''')
+
+# --------------------- ЗАПИСИ (СПРАВА - ФИЛЬТРЫ), ПРИ ЭТОМ ОФОРМЛЕНИЕ ОПРЯТНОЕ ---------------------
+
+RECORDS_LIST_COLUMNS = '''
+               r.id,
                r.date,
                IFNULL(m.name,"Техника удал/не выбрана"),
                IFNULL(d.name,"Водитель удал/не выбран"),
                r.start_time,
                r.end_time,
-               r.hours,
+               r.minutes,
                IFNULL(r.comment,"-"),
                IFNULL(c.name,"Контрагента нет"),
-               r.status
-          FROM records r
-     LEFT JOIN machines m ON r.machine_id=m.id
-     LEFT JOIN drivers d ON r.driver_id=d.id
-     LEFT JOIN counterparties c ON r.counterparty_id=c.id
-        {where_sql}
-        {order_sql}
-        LIMIT ? OFFSET ?
-    '''
-    recs=conn.execute(query, pr+[RECORDS_PER_PAGE, offset]).fetchall()
+               r.status'''
+RECORDS_STREAM_CHUNK = 200   # Строк таблицы в одном куске потокового ответа
+
+def record_row_html(r, actions=True):
+    """Строка таблицы записей; r - столбцы RECORDS_LIST_COLUMNS."""
+    rec_id=r[0]
+    mach_nm=r[2]
+    driv_nm=r[3]
+    st=r[4] or ""
+    en=r[5] or ""
+    hrs=format_minutes(r[6])
+    comm=r[7]
+    cpar=r[8]
+    stat_=r[9]
+    time_str=f"{st} - {en}" if (st and en) else "-"
+    color=COLORS['status'].get(stat_,"#fff")
+    actions_html=f'''
+            <td class="action-buttons">
+                <a href="/edit/record/{rec_id}" class="btn">Редактировать</a>
+                <form method="POST" action="/delete/record/{rec_id}">
+                    <button type="submit" class="btn btn-danger" 
+                            onclick="return confirmDelete('Удалить запись?')">
+                        Удалить
+                    </button>
+                </form>
+            </td>''' if actions else ''
+    return f'''
+        <tr>
+            <td>{format_date(r[1])}</td>
+            <td>{mach_nm}</td>
+            <td>{driv_nm}</td>
+            <td>{time_str}</td>
+            <td>{hrs}</td>
+            <td>{cpar}</td>
+            <td>{comm}</td>
+            <td>
+                <div class="status" style="background:{color};">
+                    {stat_.capitalize()}
+                </div>
+            </td>{actions_html}
+        </tr>
+        '''
 
-    machines   = conn.execute("SELECT * FROM machines ORDER BY id").fetchall()
-    drivers    = conn.execute("SELECT * FROM drivers ORDER BY id").fetchall()
-    cparties   = conn.execute("SELECT * FROM counterparties ORDER BY id").fetchall()
-    conn.close()
 
-    # Список options
-    mach_opts="".join(f'<option value="{m[0]}" {"selected" if mach_f==m[0] else ""}>{m[1]}</option>' for m in machines)
-    driv_opts="".join(f'<option value="{d[0]}" {"selected" if driv_f==d[0] else ""}>{d[1]}</option>' for d in drivers)
-    cpar_opts="".join(f'<option value="{c[0]}" {"selected" if cpar_f==c[0] else ""}>{c[1]}</option>' for c in cparties)
+@app.route('/admin/records', methods=['GET','POST'])
+@etag_by_versions(lambda: ['records', 'machines', 'drivers', 'counterparties'])
+def admin_records():
+    if request.method=='POST':
+        # Добавить запись
+        try:
+            date_str, start_t, end_t = record_form_times(request.form)
+        except ValueError as e:
+            return record_form_error(e)
+        machine_id=int(request.form['machine_id'])
+        driver_id =int(request.form['driver_id'])
+        status= request.form['status']
+        comm   = request.form.get('comment','')
+        c_id   = request.form.get('counterparty_id')
+        cpar_id= int(c_id) if c_id else None
+
+        # Проверка и вставка в одной транзакции записи - параллельно пересечение не появится
+        conn = get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        if request.form.get('allow_overlap')!='1':
+            conflicts = find_overlaps(conn, date_str, start_t, end_t, machine_id, driver_id)
+            if conflicts:
+                conn.rollback()
+                return overlap_page(conflicts, '/admin/records')
+        insert_record(date_str,machine_id,driver_id,status,start_t or None,end_t or None,comm,cpar_id)
+        return redirect('/admin/records')
+
+    # GET
+    # Фильтры
+    filters=get_records_filters(request.args)
+    date_from=filters['date_from']
+    date_to=  filters['date_to']
+    mach_f=  filters['mach']
+    driv_f=  filters['driv']
+    cpar_f=  filters['cpar']
+    stat_f=  filters['status']
+    comm_sub=filters['comment_sub']
+    sort_key=filters['sort']
+    per_page=records_page_size(request.args)
+    printable=per_page is None
+
+    where_sql, pr = build_records_where(filters)
 
-    # Форма фильтров - справа
+    conn = get_db()
+    if printable:
+        # Все записи по фильтру читаются уже при отдаче ответа, см. body();
+        # там же и считаются - без отдельного COUNT(*) до первого байта
+        total_count=None
+        recs=None
+        next_token=prev_token=None
+    else:
+        total_count=count_records(conn, where_sql, pr)
+        recs, next_token, prev_token = fetch_records_page(conn, RECORDS_LIST_COLUMNS,
+            filters, per_page,
+            after=request.args.get('after'), before=request.args.get('before'))
+
+    refs = get_ref_data(conn)
+
+    # Список options
+    mach_opts=with_selected(refs['machines']['options'], mach_f)
+    driv_opts=with_selected(refs['drivers']['options'], driv_f)
+    cpar_opts=with_selected(refs['counterparties']['options'], cpar_f)
+    size_opts="".join(
+        f'<option value="{size}" {"selected" if size==per_page else ""}>{size}</option>'
+        for size in RECORDS_PAGE_SIZES
+    )+f'<option value="all" {"selected" if printable else ""}>Все (печать)</option>'
+
+    # Форма фильтров - справа (в разметке идёт первой, чтобы уйти клиенту до строк таблицы)
     def sel(a,b): return "selected" if a==b else ""
     filters_html=f'''
     <div class="card" style="margin-bottom:1rem;">
@@ -921,19 +2260,30 @@ def admin_records():
             </select>
             <label>Комментарий (поиск):</label>
             <input type="text" name="comment_sub" value="{comm_sub}">
+            <label>Записей на странице:</label>
+            <select name="per_page">
+                {size_opts}
+            </select>
+            <input type="hidden" name="sort" value="{escape(sort_key)}">
             <button type="submit" class="btn" style="margin-top:1rem;">Применить</button>
-            <a class="btn" href="{url_for('export_excel')}?export=filtered
+            <a class="btn" href="{url_for('export_excel')}?export=filtered&job=1
                 &date_from={date_from}&date_to={date_to}
                 &mach={mach_f or ''}&driv={driv_f or ''}&cpar={cpar_f or ''}
                 &status={stat_f}&comment_sub={comm_sub}&sort={sort_key}">
                 Экспорт
             </a>
+            <a class="btn" href="{url_for('export_excel')}?export=filtered&by=machine
+                &date_from={date_from}&date_to={date_to}
+                &mach={mach_f or ''}&driv={driv_f or ''}&cpar={cpar_f or ''}
+                &status={stat_f}&comment_sub={comm_sub}&sort={sort_key}">
+                Экспорт по технике
+            </a>
         </form>
     </div>
     '''
 
-    # Форма добавления слева
-    create_form_html=f'''
+    # Форма добавления слева (в режиме печати не нужна)
+    create_form_html='' if printable else f'''
     <div class="card">
         <h2>Добавить новую запись</h2>
         <form method="POST">
@@ -941,11 +2291,11 @@ def admin_records():
                 <input type="date" name="date" required>
                 <select name="machine_id" required>
                     <option value="">Выберите технику</option>
-                    {"".join(f'<option value="{m[0]}">{m[1]}</option>' for m in machines)}
+                    {refs['machines']['options']}
                 </select>
                 <select name="driver_id" required>
                     <option value="">Выберите водителя</option>
-                    {"".join(f'<option value="{d[0]}">{d[1]}</option>' for d in drivers)}
+                    {refs['drivers']['options']}
                 </select>
                 <select name="status" required>
                     <option value="work">Работа</option>
@@ -957,7 +2307,7 @@ def admin_records():
                 <input type="time" name="end_time"   placeholder="Конец">
                 <select name="counterparty_id">
                     <option value="">Контрагент (не обязательно)</option>
-                    {"".join(f'<option value="{c[0]}">{c[1]}</option>' for c in cparties)}
+                    {refs['counterparties']['options']}
                 </select>
                 <input type="text" name="comment" placeholder="Комментарий" style="grid-column:span 2;">
             </div>
@@ -966,75 +2316,49 @@ def admin_records():
     </div>
     '''
 
-    # Список записей
-    rows_html=""
-    for r in recs:
-        rec_id=r[0]
-        date_db=r[1]
-        mach_nm=r[2]
-        driv_nm=r[3]
-        st=r[4] or ""
-        en=r[5] or ""
-        hrs=r[6] or 0
-        comm=r[7]
-        cpar=r[8]
-        stat_=r[9]
-        try:
-            date_fmt=datetime.strptime(date_db,'%Y-%m-%d').strftime('%d.%m.%Y')
-        except:
-            date_fmt=date_db
-        time_str=f"{st} - {en}" if (st and en) else "-"
-        color=COLORS['status'].get(stat_,"#fff")
-        rows_html+=f'''
-        <tr>
-            <td>{date_fmt}</td>
-            <td>{mach_nm}</td>
-            <td>{driv_nm}</td>
-            <td>{time_str}</td>
-            <td>{hrs}</td>
-            <td>{cpar}</td>
-            <td>{comm}</td>
-            <td>
-                <div class="status" style="background:{color};">
-                    {stat_.capitalize()}
-                </div>
-            </td>
-            <td class="action-buttons">
-                <a href="/edit/record/{rec_id}" class="btn">Редактировать</a>
-                <form method="POST" action="/delete/record/{rec_id}">
-                    <button type="submit" class="btn btn-danger" 
-                            onclick="return confirmDelete('Удалить запись?')">
-                        Удалить
-                    </button>
-                </form>
-            </td>
-        </tr>
-        '''
-
-    pagination_html=""
-    if total_pages>1:
-        pagination_html+='<div class="pagination">'
-        if page>1:
-            prevp=page-1
-            qstr=request.query_string.decode("utf-8")
-            pagination_html+=f'<a class="btn" href="?{qstr.replace(f"page={page}",f"page={prevp}")}">←</a>'
+    def page_url(**token):
+        args=request.args.to_dict()
+        args.pop('after',None)
+        args.pop('before',None)
+        args.pop('page',None)
+        args.update(token)
+        return "?"+urlencode(args)
+
+    def pagination_html(streamed):
+        # Токены страниц известны только после чтения строк - подвал собирается в конце
+        if printable:
+            return f'<div class="pagination"><span>Всего записей: {streamed}</span></div>'
+        if not (next_token or prev_token or total_count):
+            return ''
+        parts=['<div class="pagination">']
+        if prev_token:
+            parts.append(f'<a class="btn" href="{escape(page_url(before=prev_token))}">←</a>')
         else:
-            pagination_html+='<span>←</span>'
-        pagination_html+=f'<span>Стр. {page}/{total_pages}</span>'
-        if page<total_pages:
-            nextp=page+1
-            qstr=request.query_string.decode("utf-8")
-            if "page=" in qstr:
-                pagination_html+=f'<a class="btn" href="?{qstr.replace(f"page={page}",f"page={nextp}")}">→</a>'
-            else:
-                pagination_html+=f'<a class="btn" href="?{qstr}&page={nextp}">→</a>'
+            parts.append('<span>←</span>')
+        if total_count is not None:
+            parts.append(f'<span>Всего записей: {total_count}</span>')
+        if next_token:
+            parts.append(f'<a class="btn" href="{escape(page_url(after=next_token))}">→</a>')
         else:
-            pagination_html+='<span>→</span>'
-        pagination_html+='</div>'
+            parts.append('<span>→</span>')
+        parts.append('</div>')
+        return "".join(parts)
 
-    table_html=f'''
+    actions_th='' if printable else '<th>Действия</th>'
+    print_btn='<button type="button" class="btn no-print" onclick="window.print()">Печать</button>' if printable else ''
+
+    def body():
+        # Размещаем всё в flex: слева добавление + таблица, справа фильтры
+        yield f'''
+    <a href="/admin" class="btn back-btn">← Назад</a>
+    <div style="display:flex;align-items:flex-start;gap:1rem;flex-wrap:wrap;">
+        <div class="records-filters" style="width:300px;flex-shrink:0;order:2;">
+            {filters_html}
+        </div>
+        <div style="flex:1;min-width:400px;">
+            {create_form_html}
     <div class="card" style="margin-top:1rem;">
-        <h2>Список записей</h2>
+        <h2>Список записей {print_btn}</h2>
         <table style="margin-top:1rem;">
             <tr>
                 <th onclick="sortBy('date')">Дата</th>
@@ -1045,28 +2369,34 @@ def admin_records():
                 <th>Контрагент</th>
                 <th>Комментарий</th>
                 <th onclick="sortBy('status')">Статус</th>
-                <th>Действия</th>
+                {actions_th}
             </tr>
-            {rows_html}
+    '''
+        chunk=[]
+        streamed=0
+        # get_db() здесь, а не в обработчике: соединение обработчика закрывается
+        # до начала потоковой отдачи
+        for r in recs if recs is not None else iter_records(get_db(), RECORDS_LIST_COLUMNS, filters):
+            chunk.append(record_row_html(r, actions=not printable))
+            streamed+=1
+            if len(chunk)>=RECORDS_STREAM_CHUNK:
+                yield "".join(chunk)
+                chunk=[]
+        yield "".join(chunk)
+        yield f'''
         </table>
-        {pagination_html}
+        {pagination_html(streamed)}
     </div>
-    '''
-
-    # Размещаем всё в flex: слева добавление + таблица, справа фильтры
-    content=f'''
-    <a href="/admin" class="btn back-btn">← Назад</a>
-    <div style="display:flex;align-items:flex-start;gap:1rem;flex-wrap:wrap;">
-        <div style="flex:1;min-width:400px;">
-            {create_form_html}
-            {table_html}
-        </div>
-        <div style="width:300px;flex-shrink:0;">
-            {filters_html}
         </div>
     </div>
     '''
-    return render_base(content)
+
+    if printable:
+        # Все записи - потоком: первый байт не ждёт чтения всей выборки
+        return Response(stream_in_request(stream_base(body())), mimetype='text/html')
+    # Страница - не больше RECORDS_PAGE_SIZES[-1] строк: собираем целиком, чтобы
+    # работали ETag-ответ, заголовки X-SQL-* и ?sql_trace=1
+    return render_base("".join(body()))
 
 # --------------------- РЕДАКТИРОВАНИЕ ЗАПИСИ ---------------------
 
@@ -1075,26 +2405,25 @@ def edit_record(id):
     conn = get_db()
     if request.method=='POST':
         try:
-            date_str=request.form['date']
+            date_str, start_t, end_t = record_form_times(request.form)
+        except ValueError as e:
+            return record_form_error(e)
+        try:
             machine_id=int(request.form['machine_id'])
             driver_id =int(request.form['driver_id'])
             status=   request.form['status']
-            start_t=  request.form.get('start_time','')
-            end_t=    request.form.get('end_time','')
             comm=     request.form.get('comment','')
             c_id=     request.form.get('counterparty_id')
             cpar_id=  int(c_id) if c_id else None
 
-            hours=0
-            if start_t and end_t:
-                try:
-                    st=datetime.strptime(start_t,'%H:%M')
-                    en=datetime.strptime(end_t,'%H:%M')
-                    if en<st: en+=timedelta(days=1)
-                    hours=(en-st).seconds//3600
-                except:
-                    pass
+            hours, minutes=record_durations(start_t, end_t)
 
+            conn.execute("BEGIN IMMEDIATE")
+            if request.form.get('allow_overlap')!='1':
+                conflicts = find_overlaps(conn, date_str, start_t, end_t, machine_id, driver_id, exclude_id=id)
+                if conflicts:
+                    conn.rollback()
+                    return overlap_page(conflicts, f'/edit/record/{id}')
             conn.execute('''
                 UPDATE records
                    SET date=?,
@@ -1104,16 +2433,15 @@ def edit_record(id):
                        start_time=?,
                        end_time=?,
                        hours=?,
+                       minutes=?,
                        comment=?,
                        counterparty_id=?
                  WHERE id=?
-            ''',(date_str,machine_id,driver_id,status,start_t or None,end_t or None,hours,comm,cpar_id,id))
+            ''',(date_str,machine_id,driver_id,status,start_t or None,end_t or None,hours,minutes,comm,cpar_id,id))
             conn.commit()
         except Exception as e:
             print(f"Ошибка редактирования: {e}")
             conn.rollback()
-        finally:
-            conn.close()
         return redirect('/admin/records')
     else:
         record = conn.execute('''
@@ -1123,13 +2451,9 @@ def edit_record(id):
         ''',(id,)).fetchone()
 
         if not record:
-            conn.close()
             return render_base("<h2>Запись не найдена</h2>"),404
 
-        machines  = conn.execute("SELECT * FROM machines ORDER BY id").fetchall()
-        drivers   = conn.execute("SELECT * FROM drivers ORDER BY id").fetchall()
-        cparties  = conn.execute("SELECT * FROM counterparties ORDER BY id").fetchall()
-        conn.close()
+        refs = get_ref_data(conn)
 
         date_val=record[0]
         mach_val=record[1]
@@ -1141,16 +2465,14 @@ def edit_record(id):
         cpar_val=record[8]
 
         def sel(a,b): return "selected" if a==b else ""
-        mach_opts="".join(f'<option value="{m[0]}" {sel(m[0],mach_val)}>{m[1]}</option>' for m in machines)
-        driv_opts="".join(f'<option value="{d[0]}" {sel(d[0],driv_val)}>{d[1]}</option>' for d in drivers)
+        mach_opts=with_selected(refs['machines']['options'], mach_val)
+        driv_opts=with_selected(refs['drivers']['options'], driv_val)
 
         status_opts=""
         for s_val, s_lbl in [('work','Работа'),('stop','Простой'),('repair','Ремонт'),('holiday','Выходной')]:
             status_opts+=f'<option value="{s_val}" {sel(s_val,stat_val)}>{s_lbl}</option>'
 
-        cparty_opts='<option value="">Контрагент (не обязательно)</option>'
-        for cp in cparties:
-            cparty_opts+=f'<option value="{cp[0]}" {sel(cp[0],cpar_val)}>{cp[1]}</option>'
+        cparty_opts='<option value="">Контрагент (не обязательно)</option>'+with_selected(refs['counterparties']['options'], cpar_val)
 
         return render_base(f'''
             <a href="/admin/records" class="btn back-btn">← Назад</a>
@@ -1191,157 +2513,1028 @@ def delete_record(id):
     except:
         conn.rollback()
         return "Ошибка удаления записи", 500
-    finally:
-        conn.close()
     return redirect('/admin/records')
 
+# --------------------- ИМПОРТ ЗАПИСЕЙ ---------------------
+
+# Заголовок столбца (как в выгрузках xlsx или CSV) -> поле записи
+IMPORT_COLUMNS = {
+    "дата": "date", "date": "date",
+    "техника": "machine", "machine": "machine",
+    "водитель": "driver", "driver": "driver",
+    "статус": "status", "status": "status",
+    "начало": "start_time", "start_time": "start_time",
+    "конец": "end_time", "end_time": "end_time",
+    "контрагент": "counterparty", "counterparty": "counterparty",
+    "комментарий": "comment", "comment": "comment",
+}
+IMPORT_STATUSES = {
+    "work": "work", "работа": "work",
+    "stop": "stop", "простой": "stop",
+    "repair": "repair", "ремонт": "repair",
+    "holiday": "holiday", "выходной": "holiday",
+}
+# Заглушки, которые пишет выгрузка вместо пустых значений
+IMPORT_EMPTY = {"", "-", "контрагента нет"}
+
+def read_import_rows(upload):
+    """Строки загруженного файла (xlsx или CSV) как кортежи значений, включая заголовок."""
+    name = (upload.filename or "").lower()
+    if name.endswith((".xlsx", ".xlsm")):
+        wb = load_workbook(upload.stream, read_only=True, data_only=True)
+        try:
+            yield from wb.active.iter_rows(values_only=True)
+        finally:
+            wb.close()
+        return
+    text = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+    sample = text.read(4096)
+    text.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(text, dialect)
+
+def _import_date(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    value = str(value or "").strip()
+    for fmt in ('%Y-%m-%d', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            pass
+    raise ValueError(f"неверная дата '{value}'")
+
+def _import_time(value):
+    if value is None or str(value).strip()=="":
+        return None
+    if hasattr(value, 'strftime'):
+        return value.strftime('%H:%M')
+    value = str(value).strip()
+    try:
+        return datetime.strptime(value[:5], '%H:%M').strftime('%H:%M')
+    except ValueError:
+        raise ValueError(f"неверное время '{value}'")
+
+def parse_import_rows(rows, refs):
+    """Проверка строк импорта и перевод названий в id.
+
+    Возвращает (кортежи для INSERT без id, [(номер строки, ошибка), ...]).
+    """
+    names = {t: {r[1].strip().lower(): r[0] for r in refs[t]['rows']} for t in REF_TABLES}
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return [], [(1, "файл пуст")]
+    fields = [IMPORT_COLUMNS.get(str(h or "").strip().lower()) for h in header]
+    missing = {"date", "machine", "driver", "status"}-set(fields)
+    if missing:
+        return [], [(1, "нет столбцов: "+", ".join(sorted(missing)))]
+
+    values, errors = [], []
+    for line_no, row in enumerate(rows, start=2):
+        rec = {f: v for f, v in zip(fields, row) if f}
+        if all(v is None or str(v).strip()=="" for v in rec.values()):
+            continue
+        try:
+            date_str = _import_date(rec.get("date"))
+            machine = str(rec.get("machine") or "").strip()
+            if machine.lower() not in names['machines']:
+                raise ValueError(f"техника '{machine}' не найдена")
+            driver = str(rec.get("driver") or "").strip()
+            if driver.lower() not in names['drivers']:
+                raise ValueError(f"водитель '{driver}' не найден")
+            status = IMPORT_STATUSES.get(str(rec.get("status") or "").strip().lower())
+            if status is None:
+                raise ValueError(f"неизвестный статус '{rec.get('status')}'")
+            cparty = str(rec.get("counterparty") or "").strip()
+            cpar_id = None
+            if cparty.lower() not in IMPORT_EMPTY:
+                cpar_id = names['counterparties'].get(cparty.lower())
+                if cpar_id is None:
+                    raise ValueError(f"контрагент '{cparty}' не найден")
+            start_t = _import_time(rec.get("start_time"))
+            end_t = _import_time(rec.get("end_time"))
+            comment = str(rec.get("comment") or "").strip()
+            if comment=="-":
+                comment = ""
+        except ValueError as e:
+            errors.append((line_no, str(e)))
+            continue
+        values.append((date_str, names['machines'][machine.lower()], names['drivers'][driver.lower()],
+                       status, start_t, end_t, *record_durations(start_t, end_t), comment, cpar_id))
+    return values, errors
+
+def import_records(conn, values):
+    """Вставка разобранных строк одним executemany в одной транзакции."""
+    try:
+        ids = get_next_free_ids(conn, "records", len(values))
+        conn.executemany('''
+            INSERT INTO records
+            (id,date,machine_id,driver_id,status,start_time,end_time,hours,minutes,comment,counterparty_id)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ''', [(i, *v) for i, v in zip(ids, values)])
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+@app.route('/admin/records/import', methods=['GET','POST'])
+def import_records_view():
+    result_html = ""
+    if request.method=='POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            return render_base("<h2>Файл не выбран</h2>"),400
+        conn = get_db()
+        try:
+            values, errors = parse_import_rows(read_import_rows(upload), get_ref_data(conn))
+        except Exception as e:
+            values, errors = [], [(0, f"не удалось прочитать файл: {e}")]
+        skip_invalid = request.form.get('skip_invalid')=='1'
+        imported = 0
+        if values and (not errors or skip_invalid):
+            import_records(conn, values)
+            imported = len(values)
+        err_rows = "".join(f"<tr><td>{n}</td><td>{escape(msg)}</td></tr>" for n, msg in errors)
+        result_html = f'''
+        <div class="card">
+            <h2>Импортировано записей: {imported}</h2>
+            {"<p>Из-за ошибок ничего не загружено. Исправьте файл или включите пропуск ошибочных строк.</p>" if errors and not imported and values else ""}
+            {f"<table><tr><th>Строка</th><th>Ошибка</th></tr>{err_rows}</table>" if errors else ""}
+        </div>
+        '''
+    return render_base(f'''
+        <a href="/admin/records" class="btn back-btn">← Назад</a>
+        <div class="card">
+            <h1>Импорт записей</h1>
+            <p style="margin:1rem 0;">
+                Файл xlsx или CSV со столбцами как в выгрузке: Дата, Техника, Водитель, Статус,
+                Начало, Конец, Контрагент, Комментарий. Техника, водители и контрагенты
+                должны уже быть в справочниках.
+            </p>
+            <form method="POST" enctype="multipart/form-data">
+                <input type="file" name="file" accept=".xlsx,.csv" required>
+                <label><input type="checkbox" name="skip_invalid" value="1" style="min-width:0;"> Пропустить строки с ошибками</label>
+                <button type="submit" class="btn">Загрузить</button>
+            </form>
+        </div>
+        {result_html}
+    ''')
+
 # --------------------- ВЫГРУЗКА В EXCEL ---------------------
 
+EXPORT_CHUNK_SIZE = 1000  # Сколько строк забирать из курсора за раз
+EXPORT_HEADERS = ["Дата","Техника","Водитель","Статус","Начало","Конец","Часы","Контрагент","Комментарий"]
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def export_query(args, filtered=None, extra=None):
+    """SQL и параметры выгрузки: export=filtered - фильтры как в /admin/records, иначе все записи.
+
+    extra=(условие, параметры) - дополнительное условие WHERE (например, одна техника).
+    """
+    if filtered is None:
+        filtered = args.get('export')=='filtered'
+    if filtered:
+        filters=get_records_filters(args)
+        where_sql, pr = build_records_where(filters)
+        order_sql = records_order_sql(filters['sort'])
+    else:
+        where_sql, pr = "", []
+        order_sql = "ORDER BY r.date ASC, r.id ASC"
+    if extra:
+        cond, extra_pr = extra
+        where_sql = f"{where_sql} AND {cond}" if where_sql else f"WHERE {cond}"
+        pr = list(pr)+list(extra_pr)
+    sql = f'''
+        SELECT r.date,
+               IFNULL(m.name,"Техника нет/удалена"),
+               IFNULL(d.name,"Водитель нет/удалён"),
+               r.status,
+               IFNULL(r.start_time,""),
+               IFNULL(r.end_time,""),
+               ROUND(r.minutes/60.0, 2),
+               IFNULL(c.name,"Контрагента нет"),
+               IFNULL(r.comment,"-")
+          FROM records r
+     LEFT JOIN machines m ON r.machine_id=m.id
+     LEFT JOIN drivers d ON r.driver_id=d.id
+     LEFT JOIN counterparties c ON r.counterparty_id=c.id
+        {where_sql}
+        {order_sql}
+    '''
+    return sql, pr
+
+def iter_rows(cursor, size=EXPORT_CHUNK_SIZE):
+    """Строки курсора порциями по size, без fetchall()."""
+    while True:
+        chunk = cursor.fetchmany(size)
+        if not chunk:
+            break
+        yield from chunk
+
+def write_records_xlsx(rows, fileobj, title="AN-30 Отчёт"):
+    """Пишет строки выгрузки в xlsx в режиме write-only (память не растёт с числом строк)."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title)
+    # Общие именованные стили вместо отдельного PatternFill на каждую строку
+    xlsx_report.add_export_styles(wb, COLORS['status'], ws)
+    xlsx_report.write_records_sheet(ws, rows, EXPORT_HEADERS, COLORS['status'])
+    wb.save(fileobj)
+
+def send_temp_file(fileobj, download_name, mimetype):
+    """Отдаёт анонимный временный файл; он удаляется, когда сервер его закроет."""
+    fileobj.seek(0)
+    return send_file(fileobj, as_attachment=True, download_name=download_name, mimetype=mimetype)
+
 @app.route('/export')
 def export_excel():
-    export_mode = request.args.get('export')
+    if request.args.get('job')=='1':
+        # Долгая выгрузка - фоновым заданием, см. ФОНОВАЯ ВЫГРУЗКА
+        job_id = start_export_job(request.args)
+        if request.args.get('format')=='json':
+            return jsonify({"id": job_id, "status_url": url_for('export_job_status', job_id=job_id)}), 202
+        return redirect(url_for('export_job_status', job_id=job_id))
+    if request.args.get('by')=='machine':
+        return export_workbook_by_machine(request.args)
+    sql, pr = export_query(request.args)
+
+    # TemporaryFile не имеет имени в каталоге: одновременные выгрузки
+    # не перезаписывают друг друга, а файл исчезает после отправки
+    tmp = tempfile.TemporaryFile(prefix="an30_report_", suffix=".xlsx")
+    conn = get_db()
+    try:
+        write_records_xlsx(iter_rows(conn.execute(sql, pr)), tmp)
+    except:
+        tmp.close()
+        raise
 
+    filename="report_"+datetime.now().strftime("%Y%m%d_%H%M")+".xlsx"
+    return send_temp_file(tmp, filename, XLSX_MIMETYPE)
+
+# --------------------- КНИГА ПО ТЕХНИКЕ ---------------------
+
+# /export?by=machine: сводный лист и по листу на каждую технику. Листы строятся
+# параллельно в пуле процессов и склеиваются в одну книгу (см. xlsx_report).
+app.config['EXPORT_WORKBOOK_PROCESSES'] = None   # None - по числу ядер
+WORKBOOK_SUMMARY_TITLE = "Итоги"
+WORKBOOK_SUMMARY_HEADERS = ["Техника","Записей","Работа, ч","Простой, ч","Ремонт, ч","Выходной, ч","Всего, ч","Загрузка, %"]
+_workbook_pool = None
+_workbook_pool_pid = None
+_workbook_pool_lock = threading.Lock()
+
+def get_workbook_pool():
+    """Пул процессов для листов книги. Контекст spawn: дочерним процессам не
+    достаются потоки и открытые соединения воркера, как было бы при fork."""
+    global _workbook_pool, _workbook_pool_pid
+    with _workbook_pool_lock:
+        if _workbook_pool is None or _workbook_pool_pid!=os.getpid():
+            _workbook_pool = ProcessPoolExecutor(app.config['EXPORT_WORKBOOK_PROCESSES'] or os.cpu_count(),
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            _workbook_pool_pid = os.getpid()
+        return _workbook_pool
+
+def workbook_summary(conn, args, filtered):
+    """Итоги по технике одним запросом: [(machine_id, название, записей, {статус: минуты})]."""
+    where_sql, pr = build_records_where(get_records_filters(args)) if filtered else ("", [])
+    machines = OrderedDict()
+    for machine_id, name, status_, cnt, minutes in conn.execute(f'''
+        SELECT r.machine_id, IFNULL(m.name,"Техника нет/удалена"), r.status, COUNT(*), SUM(r.minutes)
+          FROM records r
+     LEFT JOIN machines m ON r.machine_id=m.id
+        {where_sql}
+      GROUP BY r.machine_id, r.status
+      ORDER BY 2, r.machine_id
+    ''', pr):
+        item = machines.setdefault(machine_id, [machine_id, name, 0, {}])
+        item[2] += cnt
+        item[3][status_] = minutes or 0
+    return list(machines.values())
+
+def export_workbook_by_machine(args):
+    filtered = args.get('export')=='filtered'
     conn = get_db()
+    summary = workbook_summary(conn, args, filtered)
+
+    rows = []
+    sheets = []
+    titles = xlsx_report.sheet_titles([name for _, name, _, _ in summary], reserved=[WORKBOOK_SUMMARY_TITLE])
+    for (machine_id, name, cnt, minutes), title in zip(summary, titles):
+        hours = [round(minutes.get(s, 0)/60, 2) for s in RECORD_STATUSES]
+        logged = sum(minutes.get(s, 0) for s in analytics.LOGGED_STATUSES)
+        util = round(minutes.get('work', 0)*100/logged, 1) if logged else None
+        rows.append([name, cnt, *hours, round(sum(minutes.values())/60, 2), util])
+        extra = ("r.machine_id=?", [machine_id]) if machine_id is not None else ("r.machine_id IS NULL", [])
+        sql, pr = export_query(args, filtered, extra)
+        sheets.append((title, sql, pr))
+    if rows:
+        totals = [sum(r[i] for r in rows) for i in range(1, 7)]
+        logged = sum(sum(m.get(s, 0) for s in analytics.LOGGED_STATUSES) for _, _, _, m in summary)
+        work = sum(m.get('work', 0) for _, _, _, m in summary)
+        rows.append(["Итого", totals[0], *[round(h, 2) for h in totals[1:]],
+                     round(work*100/logged, 1) if logged else None])
+
+    tmp = tempfile.TemporaryFile(prefix="an30_report_", suffix=".xlsx")
     try:
-        if export_mode=='filtered':
-            # Те же фильтры, что и в /admin/records
-            date_from=request.args.get('date_from','')
-            date_to=  request.args.get('date_to','')
-            mach_f=  request.args.get('mach',  type=int)
-            driv_f=  request.args.get('driv',  type=int)
-            cpar_f=  request.args.get('cpar',  type=int)
-            stat_f=  request.args.get('status','')
-            comm_sub=request.args.get('comment_sub','').strip()
-            sort_key=request.args.get('sort','date_desc')
-
-            wh=[]
-            pr=[]
-            if date_from:
-                wh.append("r.date>=?")
-                pr.append(date_from)
-            if date_to:
-                wh.append("r.date<=?")
-                pr.append(date_to)
-            if mach_f:
-                wh.append("r.machine_id=?")
-                pr.append(mach_f)
-            if driv_f:
-                wh.append("r.driver_id=?")
-                pr.append(driv_f)
-            if cpar_f:
-                wh.append("r.counterparty_id=?")
-                pr.append(cpar_f)
-            if stat_f in ("work","stop","repair","holiday"):
-                wh.append("r.status=?")
-                pr.append(stat_f)
-            if comm_sub:
-                wh.append("r.comment LIKE ?")
-                pr.append(f"%{comm_sub}%")
-
-            where_sql=""
-            if wh:
-                where_sql="WHERE "+ " AND ".join(wh)
-
-            if sort_key=="date_asc":
-                order_sql="ORDER BY r.date ASC, r.id ASC"
-            elif sort_key=="date_desc":
-                order_sql="ORDER BY r.date DESC, r.id DESC"
-            elif sort_key=="hours_asc":
-                order_sql="ORDER BY r.hours ASC, r.date ASC"
-            elif sort_key=="hours_desc":
-                order_sql="ORDER BY r.hours DESC, r.date DESC"
-            elif sort_key=="machine_asc":
-                order_sql="ORDER BY m.name ASC, r.date DESC"
-            elif sort_key=="driver_asc":
-                order_sql="ORDER BY d.name ASC, r.date DESC"
-            else:
-                order_sql="ORDER BY r.date DESC, r.id DESC"
-
-            sql = f'''
-                SELECT r.date,
-                       IFNULL(m.name,"Техника нет/удалена"),
-                       IFNULL(d.name,"Водитель нет/удалён"),
-                       r.status,
-                       IFNULL(r.start_time,""),
-                       IFNULL(r.end_time,""),
-                       r.hours,
-                       IFNULL(c.name,"Контрагента нет"),
-                       IFNULL(r.comment,"-")
-                  FROM records r
-             LEFT JOIN machines m ON r.machine_id=m.id
-             LEFT JOIN drivers d ON r.driver_id=d.id
-             LEFT JOIN counterparties c ON r.counterparty_id=c.id
-                {where_sql}
-                {order_sql}
-            '''
-            rows=conn.execute(sql, pr).fetchall()
-        else:
-            # Все
-            rows=conn.execute('''
-                SELECT r.date,
-                       IFNULL(m.name,"Техника нет/удалена"),
-                       IFNULL(d.name,"Водитель нет/удалён"),
-                       r.status,
-                       IFNULL(r.start_time,""),
-                       IFNULL(r.end_time,""),
-                       r.hours,
-                       IFNULL(c.name,"Контрагента нет"),
-                       IFNULL(r.comment,"-")
-                  FROM records r
-             LEFT JOIN machines m ON r.machine_id=m.id
-             LEFT JOIN drivers d ON r.driver_id=d.id
-             LEFT JOIN counterparties c ON r.counterparty_id=c.id
-              ORDER BY r.date ASC, r.id ASC
-            ''').fetchall()
+        with tempfile.TemporaryDirectory(prefix="an30_parts_") as parts_dir:
+            xlsx_report.build_workbook(
+                tmp, get_workbook_pool(), parts_dir,
+                (WORKBOOK_SUMMARY_TITLE, WORKBOOK_SUMMARY_HEADERS, rows), sheets,
+                app.config['DATABASE'], EXPORT_HEADERS, COLORS['status'], EXPORT_CHUNK_SIZE)
+    except BrokenProcessPool:
+        # Процесс пула упал (например, OOM): следующая выгрузка создаст пул заново
+        global _workbook_pool
+        with _workbook_pool_lock:
+            _workbook_pool = None
+        tmp.close()
+        raise
+    except:
+        tmp.close()
+        raise
+
+    filename="report_by_machine_"+datetime.now().strftime("%Y%m%d_%H%M")+".xlsx"
+    return send_temp_file(tmp, filename, XLSX_MIMETYPE)
+
+# --------------------- ФОНОВАЯ ВЫГРУЗКА ---------------------
+
+# /export?job=1 ставит выгрузку в очередь и сразу отвечает номером задания.
+# Состояние заданий - в таблице export_jobs, файлы - в EXPORT_JOB_DIR, поэтому
+# опрашивать и скачивать можно через любой воркер gunicorn.
+app.config['EXPORT_JOB_WORKERS'] = 2          # Потоков выгрузки в каждом воркере
+app.config['EXPORT_JOB_DIR'] = None           # None - рядом с DATABASE: an30-exports/
+app.config['EXPORT_JOB_TTL'] = 3600           # Сколько секунд хранить готовый файл
+app.config['EXPORT_JOB_MAX_FILES'] = 20       # Сколько готовых файлов держать на диске
+app.config['EXPORT_JOB_MAX_BYTES'] = 500*1024*1024
+app.config['EXPORT_JOB_STALE'] = 600          # Задание без движения столько секунд считается упавшим
+_export_pool = None
+_export_pool_pid = None
+_export_pool_lock = threading.Lock()
+
+def migrate_export_jobs(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS export_jobs (
+            id TEXT PRIMARY KEY,
+            cache_key TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('queued', 'running', 'done', 'failed')),
+            done_rows INTEGER NOT NULL DEFAULT 0,
+            total_rows INTEGER,
+            size INTEGER,
+            error TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS export_jobs_cache_key ON export_jobs(cache_key, status)")
+
+def export_job_dir():
+    path = app.config['EXPORT_JOB_DIR'] or os.path.splitext(app.config['DATABASE'])[0]+'-exports'
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def export_job_path(job_id):
+    return os.path.join(export_job_dir(), f"{job_id}.xlsx")
+
+def get_export_pool():
+    """Пул потоков выгрузки; после fork (gunicorn --preload) создаётся заново."""
+    global _export_pool, _export_pool_pid
+    with _export_pool_lock:
+        if _export_pool is None or _export_pool_pid!=os.getpid():
+            _export_pool = ThreadPoolExecutor(app.config['EXPORT_JOB_WORKERS'], thread_name_prefix='an30-export')
+            _export_pool_pid = os.getpid()
+        return _export_pool
+
+def cleanup_export_jobs(conn):
+    """Удаляет просроченные и лишние готовые файлы, помечает зависшие задания упавшими."""
+    now = time.time()
+    conn.execute(
+        "UPDATE export_jobs SET status='failed', error='прервано', updated=? WHERE status IN ('queued','running') AND updated<?",
+        (now, now-app.config['EXPORT_JOB_STALE']))
+    expired = [r[0] for r in conn.execute(
+        "SELECT id FROM export_jobs WHERE updated<?", (now-app.config['EXPORT_JOB_TTL'],))]
+    # Сверх лимитов - самые старые готовые файлы
+    total_files, total_bytes = 0, 0
+    for job_id, size in conn.execute("SELECT id, size FROM export_jobs WHERE status='done' ORDER BY updated DESC"):
+        total_files += 1
+        total_bytes += size or 0
+        if total_files>app.config['EXPORT_JOB_MAX_FILES'] or total_bytes>app.config['EXPORT_JOB_MAX_BYTES']:
+            expired.append(job_id)
+    for job_id in set(expired):
+        try:
+            os.remove(export_job_path(job_id))
+        except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM export_jobs WHERE id=?", (job_id,))
+    conn.commit()
+
+def run_export_job(job_id, sql, pr):
+    """Выгрузка в фоне: своё соединение, прогресс в export_jobs не чаще раза в секунду."""
+    conn = connect_db()
+    tmp_path = export_job_path(job_id)+".part"
+    try:
+        conn.execute("UPDATE export_jobs SET status='running', updated=? WHERE id=?", (time.time(), job_id))
+        conn.commit()
+        total = conn.execute(f"SELECT COUNT(*) FROM ({sql})", pr).fetchone()[0]
+        conn.execute("UPDATE export_jobs SET total_rows=?, updated=? WHERE id=?", (total, time.time(), job_id))
+        conn.commit()
+
+        def rows_with_progress(rows):
+            done, reported = 0, time.monotonic()
+            progress = connect_db()
+            try:
+                for row in rows:
+                    done += 1
+                    if time.monotonic()-reported>=1:
+                        reported = time.monotonic()
+                        progress.execute("UPDATE export_jobs SET done_rows=?, updated=? WHERE id=?",
+                                         (done, time.time(), job_id))
+                        progress.commit()
+                    yield row
+            finally:
+                progress.close()
+
+        with open(tmp_path, "wb") as f:
+            write_records_xlsx(rows_with_progress(iter_rows(conn.execute(sql, pr))), f)
+        os.replace(tmp_path, export_job_path(job_id))
+        conn.execute(
+            "UPDATE export_jobs SET status='done', done_rows=total_rows, size=?, updated=? WHERE id=?",
+            (os.path.getsize(export_job_path(job_id)), time.time(), job_id))
+        conn.commit()
+        cleanup_export_jobs(conn)
+    except Exception as e:
+        app.logger.exception("Ошибка фоновой выгрузки %s", job_id)
+        if conn.in_transaction:
+            conn.rollback()
+        conn.execute("UPDATE export_jobs SET status='failed', error=?, updated=? WHERE id=?",
+                     (str(e), time.time(), job_id))
+        conn.commit()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     finally:
         conn.close()
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title="AN-30 Отчёт"
+def start_export_job(args):
+    """Задание выгрузки по параметрам /export. Та же выборка при тех же данных
+    отдаётся из уже готового (или ещё идущего) задания."""
+    sql, pr = export_query(args)
+    conn = get_db()
+    cleanup_export_jobs(conn)
+    versions = get_data_versions(conn, ['records', *REF_TABLES])
+    cache_key = hashlib.sha256(json.dumps([sql, pr, versions]).encode()).hexdigest()
+    row = conn.execute(
+        "SELECT id FROM export_jobs WHERE cache_key=? AND status IN ('queued','running','done') ORDER BY created DESC",
+        (cache_key,)).fetchone()
+    if row:
+        return row[0]
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    conn.execute("INSERT INTO export_jobs (id, cache_key, status, created, updated) VALUES (?,?,'queued',?,?)",
+                 (job_id, cache_key, now, now))
+    conn.commit()
+    get_export_pool().submit(run_export_job, job_id, sql, pr)
+    return job_id
+
+def export_job_json(job_id, row):
+    status, done_rows, total_rows, error = row
+    return {
+        "id": job_id,
+        "status": status,
+        "done_rows": done_rows,
+        "total_rows": total_rows,
+        "progress": round(done_rows/total_rows, 3) if total_rows else (1.0 if status=='done' else 0.0),
+        "error": error,
+        "status_url": url_for('export_job_status', job_id=job_id),
+        "download_url": url_for('export_job_download', job_id=job_id) if status=='done' else None,
+    }
 
-    headers=["Дата","Техника","Водитель","Статус","Начало","Конец","Часы","Контрагент","Комментарий"]
-    ws.append(headers)
+@app.route('/export/jobs/<job_id>')
+def export_job_status(job_id):
+    """Состояние задания: HTML-страница с опросом или ?format=json."""
+    row = get_db().execute(
+        "SELECT status, done_rows, total_rows, error FROM export_jobs WHERE id=?", (job_id,)).fetchone()
+    if request.args.get('format')=='json':
+        if not row:
+            return jsonify({"error": "задание не найдено"}), 404
+        return jsonify(export_job_json(job_id, row))
+    if not row:
+        return render_base('<div class="card"><h1>Задание не найдено</h1><p>Возможно, файл уже удалён по сроку хранения.</p></div>'), 404
+    job = export_job_json(job_id, row)
+    return render_base(f'''
+        <a href="/admin/records" class="btn back-btn">← Назад</a>
+        <div class="card export-job" data-job-status="{job['status_url']}?format=json">
+            <h1>Выгрузка в Excel</h1>
+            <progress max="1" value="{job['progress']}"></progress>
+            <p class="job-text">Подготовка файла...</p>
+            <a class="btn job-download" href="{url_for('export_job_download', job_id=job_id)}" hidden>Скачать</a>
+        </div>
+    ''')
 
-    header_fill=PatternFill(start_color="444444", fill_type="solid")
-    header_font=Font(color="FFFFFF", bold=True)
+@app.route('/export/jobs/<job_id>/download')
+def export_job_download(job_id):
+    row = get_db().execute("SELECT status, created FROM export_jobs WHERE id=?", (job_id,)).fetchone()
+    if not row or row[0]!='done' or not os.path.exists(export_job_path(job_id)):
+        return render_base('<div class="card"><h1>Файл недоступен</h1></div>'), 404
+    filename = "report_"+datetime.fromtimestamp(row[1]).strftime("%Y%m%d_%H%M")+".xlsx"
+    return send_file(export_job_path(job_id), as_attachment=True, download_name=filename, mimetype=XLSX_MIMETYPE)
 
-    for col in range(1,len(headers)+1):
-        cell=ws.cell(row=1,column=col)
-        cell.fill=header_fill
-        cell.font=header_font
-        ws.column_dimensions[get_column_letter(col)].width=20
+# --------------------- ПОТОКОВАЯ ВЫГРУЗКА CSV / NDJSON ---------------------
 
-    for row in rows:
-        # row => date, machine, driver, status, start, end, hours, cparty, comment
-        date_db=row[0]
-        try:
-            date_fmt=datetime.strptime(date_db,'%Y-%m-%d').strftime('%d.%m.%Y')
-        except:
-            date_fmt=date_db
-        machine=row[1]
-        driver=row[2]
-        status_=row[3]
-        st_=row[4]
-        en_=row[5]
-        hrs_=row[6]
-        cpar_=row[7]
-        comm_=row[8]
-        color_hex=COLORS['status'].get(status_,"#FFFFFF")[1:]
-
-        ws.append([date_fmt,machine,driver,status_.capitalize(),st_,en_,hrs_,cpar_,comm_])
-        scell=ws.cell(row=ws.max_row,column=4) # столбец "Статус"
-        scell.fill=PatternFill(start_color=color_hex, fill_type="solid")
+EXPORT_FIELDS = ["date","machine","driver","status","start_time","end_time","hours","counterparty","comment"]
 
-    filename="report_"+datetime.now().strftime("%Y%m%d_%H%M")+".xlsx"
-    wb.save(filename)
-    return send_file(
-        filename,
-        as_attachment=True,
-        download_name=filename,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+def stream_export(sql, pr, encode_chunk, head=""):
+    """Генератор ответа: строки идут из курсора порциями.
+
+    Оборачивается в stream_in_request, чтобы соединение запроса жило до конца ответа.
+    """
+    if head:
+        yield head
+    conn = get_db()
+    cur = conn.execute(sql, pr)
+    while True:
+        chunk = cur.fetchmany(EXPORT_CHUNK_SIZE)
+        if not chunk:
+            break
+        yield encode_chunk(chunk)
+
+def streamed_download(body, filename, mimetype):
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    # Не даём прокси (nginx) буферизовать весь ответ
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def csv_chunk(rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue()
+
+def ndjson_chunk(rows):
+    return "".join(json.dumps(dict(zip(EXPORT_FIELDS, r)), ensure_ascii=False)+"\n" for r in rows)
+
+@app.route('/export.csv')
+def export_csv():
+    """Те же фильтры и сортировка, что у /export?export=filtered."""
+    sql, pr = export_query(request.args, filtered=True)
+    head = csv_chunk([EXPORT_FIELDS])
+    filename="report_"+datetime.now().strftime("%Y%m%d_%H%M")+".csv"
+    return streamed_download(stream_in_request(stream_export(sql, pr, csv_chunk, head)), filename, 'text/csv')
+
+@app.route('/export.ndjson')
+def export_ndjson():
+    """Те же фильтры и сортировка, что у /export?export=filtered; одна запись - одна строка JSON."""
+    sql, pr = export_query(request.args, filtered=True)
+    filename="report_"+datetime.now().strftime("%Y%m%d_%H%M")+".ndjson"
+    return streamed_download(stream_in_request(stream_export(sql, pr, ndjson_chunk)), filename, 'application/x-ndjson')
+
+# --------------------- ОТЧЁТ ПО МЕСЯЦАМ ---------------------
+
+# Ключ сводной таблицы monthly_hours. Пустые ссылки (NULL) хранятся как 0,
+# чтобы ON CONFLICT срабатывал и для них.
+MONTHLY_KEY = ("month", "machine_id", "driver_id", "counterparty_id", "status")
+
+def _monthly_key_values(ref):
+    """Выражения ключа monthly_hours для NEW/OLD в теле триггера."""
+    return [f"substr({ref}.date,1,7)", f"IFNULL({ref}.machine_id,0)", f"IFNULL({ref}.driver_id,0)",
+            f"IFNULL({ref}.counterparty_id,0)", f"{ref}.status"]
+
+def _monthly_add_sql(ref):
+    return f'''
+        INSERT INTO monthly_hours ({", ".join(MONTHLY_KEY)}, minutes, records)
+        VALUES ({", ".join(_monthly_key_values(ref))}, {ref}.minutes, 1)
+        ON CONFLICT ({", ".join(MONTHLY_KEY)})
+        DO UPDATE SET minutes=minutes+excluded.minutes, records=records+1;
+    '''
+
+def _monthly_sub_sql(ref):
+    cond = " AND ".join(f"{k}={v}" for k, v in zip(MONTHLY_KEY, _monthly_key_values(ref)))
+    return f'''
+        UPDATE monthly_hours SET minutes=minutes-{ref}.minutes, records=records-1 WHERE {cond};
+        DELETE FROM monthly_hours WHERE records<=0 AND {cond};
+    '''
+
+def migrate_monthly_hours(conn):
+    """Сводная таблица часов по (месяц, техника, водитель, контрагент, статус).
+
+    Поддерживается триггерами на records; при первом создании заполняется
+    из существующих записей. Таблица из версии с целыми часами (без minutes)
+    пересоздаётся вместе с триггерами.
+    """
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(monthly_hours)")]
+    if columns and 'minutes' not in columns:
+        for event in ('ins', 'del', 'upd'):
+            conn.execute(f"DROP TRIGGER IF EXISTS trg_records_monthly_{event}")
+        conn.execute("DROP TABLE monthly_hours")
+        columns = []
+    exists = bool(columns)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS monthly_hours (
+            month TEXT NOT NULL,
+            machine_id INTEGER NOT NULL,
+            driver_id INTEGER NOT NULL,
+            counterparty_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            minutes INTEGER NOT NULL DEFAULT 0,
+            records INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY ({", ".join(MONTHLY_KEY)})
+        ) WITHOUT ROWID
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_monthly_ins AFTER INSERT ON records
+        BEGIN {_monthly_add_sql("NEW")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_monthly_del AFTER DELETE ON records
+        BEGIN {_monthly_sub_sql("OLD")} END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_records_monthly_upd
+        AFTER UPDATE OF date, machine_id, driver_id, counterparty_id, status, minutes ON records
+        BEGIN {_monthly_sub_sql("OLD")} {_monthly_add_sql("NEW")} END
+    ''')
+    if not exists:
+        rebuild_monthly_hours(conn)
+
+def rebuild_monthly_hours(conn):
+    """Пересчёт monthly_hours целиком из records."""
+    conn.execute("DELETE FROM monthly_hours")
+    conn.execute('''
+        INSERT INTO monthly_hours (month, machine_id, driver_id, counterparty_id, status, minutes, records)
+        SELECT substr(date,1,7), IFNULL(machine_id,0), IFNULL(driver_id,0), IFNULL(counterparty_id,0), status,
+               SUM(minutes), COUNT(*)
+          FROM records
+      GROUP BY 1, 2, 3, 4, 5
+    ''')
+
+# Разрезы отчёта: параметр by -> (столбец сводной таблицы, выражение названия, заголовок)
+MONTHLY_GROUPS = {
+    'machine':      ("s.machine_id",      "IFNULL(m.name,'-')", "Техника"),
+    'driver':       ("s.driver_id",       "IFNULL(d.name,'-')", "Водитель"),
+    'counterparty': ("s.counterparty_id", "IFNULL(c.name,'-')", "Контрагент"),
+    'status':       ("s.status",          "s.status",           "Статус"),
+}
+
+@app.route('/reports/monthly')
+def report_monthly():
+    """Часы по месяцам из monthly_hours: ?from=YYYY-MM&to=YYYY-MM&by=machine,status&format=json"""
+    month_from = request.args.get('from', '')
+    month_to   = request.args.get('to', '')
+    by = [b for b in request.args.get('by', 'machine').split(',') if b in MONTHLY_GROUPS] or ['machine']
+
+    where=[]
+    pr=[]
+    if month_from:
+        where.append("s.month>=?")
+        pr.append(month_from)
+    if month_to:
+        where.append("s.month<=?")
+        pr.append(month_to)
+    for key, param in (('machine_id','mach'), ('driver_id','driv'), ('counterparty_id','cpar')):
+        value = request.args.get(param, type=int)
+        if value:
+            where.append(f"s.{key}=?")
+            pr.append(value)
+    where_sql = "WHERE "+" AND ".join(where) if where else ""
+
+    group_cols = ", ".join(MONTHLY_GROUPS[b][0] for b in by)
+    name_cols  = ", ".join(MONTHLY_GROUPS[b][1] for b in by)
+    conn = get_db()
+    rows = conn.execute(f'''
+        SELECT s.month, {name_cols}, ROUND(SUM(s.minutes)/60.0, 2), SUM(s.records)
+          FROM monthly_hours s
+     LEFT JOIN machines m ON s.machine_id=m.id
+     LEFT JOIN drivers d ON s.driver_id=d.id
+     LEFT JOIN counterparties c ON s.counterparty_id=c.id
+        {where_sql}
+      GROUP BY s.month, {group_cols}
+      ORDER BY s.month, {name_cols}
+    ''', pr).fetchall()
+
+    if request.args.get('format')=='json':
+        return jsonify([
+            dict(zip(["month", *by, "hours", "records"], r)) for r in rows
+        ])
+
+    head = "".join(f"<th>{MONTHLY_GROUPS[b][2]}</th>" for b in by)
+    body = "".join(
+        "<tr>"+"".join(f"<td>{v}</td>" for v in r)+"</tr>" for r in rows
+    )
+    by_links = " ".join(
+        f'<a class="btn" href="?{urlencode({"from":month_from,"to":month_to,"by":b})}">{MONTHLY_GROUPS[b][2]}</a>'
+        for b in MONTHLY_GROUPS
+    )
+    return render_base(f'''
+        <a href="/admin" class="btn back-btn">← Назад</a>
+        <div class="card">
+            <h1>Часы по месяцам</h1>
+            <form method="GET" style="margin:1rem 0;">
+                <input type="month" name="from" value="{month_from}">
+                <input type="month" name="to" value="{month_to}">
+                <input type="hidden" name="by" value="{",".join(by)}">
+                <button type="submit" class="btn">Показать</button>
+            </form>
+            <div>{by_links}</div>
+            <table>
+                <tr><th>Месяц</th>{head}<th>Часы</th><th>Записей</th></tr>
+                {body}
+            </table>
+        </div>
+    ''')
+
+# --------------------- ЗАГРУЗКА ТЕХНИКИ ---------------------
+
+UTILIZATION_MAX_DAYS = 3*366   # Наибольший период отчёта
+
+def utilization_range(args):
+    """Период отчёта из ?from=&to= (YYYY-MM-DD); по умолчанию - последние 12 месяцев."""
+    today = datetime.now().date()
+    try:
+        date_to = datetime.strptime(args.get('to', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_to = today
+    try:
+        date_from = datetime.strptime(args.get('from', ''), '%Y-%m-%d').date()
+    except ValueError:
+        date_from = date_to-timedelta(days=364)
+    if date_from>date_to:
+        date_from, date_to = date_to, date_from
+    date_from = max(date_from, date_to-timedelta(days=UTILIZATION_MAX_DAYS-1))
+    return str(date_from), str(date_to)
+
+@app.route('/reports/utilization')
+def report_utilization():
+    """Загрузка техники по неделям/месяцам: ?from=&to=&period=week|month&mach=&format=json"""
+    date_from, date_to = utilization_range(request.args)
+    period = request.args.get('period', 'month')
+    if period not in analytics.PERIODS:
+        period = 'month'
+    conn = get_db()
+    machines = get_ref_data(conn)['machines']['rows']
+    mach_f = request.args.get('mach', type=int)
+    if mach_f:
+        machines = [m for m in machines if m[0]==mach_f]
+    names = dict(machines)
+    report = analytics.utilization(conn, date_from, date_to, sorted(names), period)
+    for m in report['machines']:
+        m['machine'] = names[m['machine_id']]
+
+    if request.args.get('format')=='json':
+        return jsonify({"from": date_from, "to": date_to, "period": period, **report})
+
+    def td(c):
+        pct = c['utilization']
+        title = ", ".join(f"{s}: {h} ч / {c['days'][s]} дн" for s, h in c['hours'].items())
+        title += f", без записей: {c['idle_days']} из {c['period_days']} дн"
+        if c['trend'] is not None:
+            title += f", к пред. периоду: {c['trend']:+} п.п."
+        style = f"background:rgba(76,175,80,{pct/100:.2f});" if pct is not None else ""
+        return f'<td class="util-cell" style="{style}" title="{escape(title)}">{"-" if pct is None else f"{pct:.0f}%"}</td>'
+
+    head = "".join(
+        f'<th title="{format_date(r["start"])} - {format_date(r["end"])}, {r["days"]} дн'
+        f'{", неполный период: изменение не считается" if r["partial"] else ""}">'
+        f'{r["start"]}{"*" if r["partial"] else ""}</th>'
+        for r in report['period_ranges']
+    )
+    body = "".join(
+        f"<tr><td>{escape(m['machine'])}</td>{''.join(td(c) for c in m['periods'])}</tr>"
+        for m in report['machines']
     )
+    fleet = f"<tr class=\"util-fleet\"><td>Весь парк</td>{''.join(td(c) for c in report['fleet'])}</tr>"
+    period_opts = "".join(
+        f'<option value="{p}" {"selected" if p==period else ""}>{label}</option>'
+        for p, label in (('month', 'По месяцам'), ('week', 'По неделям'))
+    )
+    return render_base(f'''
+        <a href="/admin" class="btn back-btn">← Назад</a>
+        <div class="card">
+            <h1>Загрузка техники</h1>
+            <p>Доля часов работы от часов работы, простоя и ремонта. Подробности - в подсказке ячейки.
+               * - неполная неделя/месяц на границе периода.</p>
+            <form method="GET" style="margin:1rem 0;">
+                <input type="date" name="from" value="{date_from}">
+                <input type="date" name="to" value="{date_to}">
+                <select name="period">{period_opts}</select>
+                <select name="mach">
+                    <option value="">[Вся техника]</option>
+                    {with_selected(get_ref_data(conn)['machines']['options'], mach_f)}
+                </select>
+                <button type="submit" class="btn">Показать</button>
+            </form>
+            <div style="overflow-x:auto;">
+                <table class="util-table">
+                    <tr><th>Техника</th>{head}</tr>
+                    {body}
+                    {fleet}
+                </table>
+            </div>
+        </div>
+    ''')
+
+# --------------------- JSON API ---------------------
+
+API_PAGE_LIMIT = 100
+API_MAX_LIMIT = 1000
+RECORD_FIELDS = ("date","machine_id","driver_id","status","start_time","end_time","comment","counterparty_id")
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.errors = errors
+
+@app.errorhandler(ApiError)
+def handle_api_error(e):
+    body = {"error": str(e)}
+    if e.errors:
+        body["errors"] = e.errors
+    return jsonify(body), e.status
+
+def api_json_list(key=None):
+    """Тело запроса: список объектов (или {key: [...]})."""
+    data = request.get_json(silent=True)
+    if key and isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list):
+        raise ApiError("ожидается JSON-массив" if not key else f"ожидается JSON-массив или {{'{key}': [...]}}")
+    return data
+
+def api_apply_batch(conn, items, apply_item):
+    """Применяет apply_item к каждому элементу в одной транзакции; при любой ошибке - откат и 400/409."""
+    errors = []
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        for index, item in enumerate(items):
+            try:
+                apply_item(index, item)
+            except (ValueError, TypeError, KeyError) as e:
+                errors.append({"index": index, "error": str(e)})
+            except sqlite3.IntegrityError as e:
+                errors.append({"index": index, "error": f"нарушение ограничений: {e}"})
+        if errors:
+            raise ApiError("изменения не применены", 400, errors)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def record_to_json(row):
+    return dict(zip(("id","date","machine_id","driver_id","status","start_time","end_time",
+                     "minutes","hours","comment","counterparty_id","machine","driver","counterparty"), row))
+
+API_RECORD_COLUMNS = '''
+               r.id, r.date, r.machine_id, r.driver_id, r.status, r.start_time, r.end_time,
+               r.minutes, ROUND(r.minutes/60.0, 2), r.comment, r.counterparty_id, m.name, d.name, c.name'''
+
+def validate_record_json(item, base=None):
+    """Проверенный кортеж значений RECORD_FIELDS; base - текущие значения для частичного обновления."""
+    if not isinstance(item, dict):
+        raise ValueError("ожидается объект")
+    rec = dict(base or {})
+    rec.update({k: item[k] for k in RECORD_FIELDS if k in item})
+    for k in ("date","machine_id","driver_id","status"):
+        if rec.get(k) in (None, ""):
+            raise ValueError(f"не указано поле {k}")
+    # Хранятся только нормализованные строки: фильтры и календарь сравнивают даты как строки
+    if not isinstance(rec["date"], str):
+        raise ValueError("date должно быть строкой YYYY-MM-DD")
+    rec["date"] = datetime.strptime(rec["date"], '%Y-%m-%d').strftime('%Y-%m-%d')
+    if rec["status"] not in RECORD_STATUSES:
+        raise ValueError(f"неизвестный статус '{rec['status']}'")
+    for k in ("start_time","end_time"):
+        if rec.get(k):
+            if not isinstance(rec[k], str):
+                raise ValueError(f"{k} должно быть строкой HH:MM")
+            rec[k] = datetime.strptime(rec[k], '%H:%M').strftime('%H:%M')
+        else:
+            rec[k] = None
+    cpar = rec.get("counterparty_id")
+    return (rec["date"], int(rec["machine_id"]), int(rec["driver_id"]), rec["status"],
+            rec["start_time"], rec["end_time"], *record_durations(rec["start_time"], rec["end_time"]),
+            rec.get("comment") or "", int(cpar) if cpar not in (None, "") else None)
+
+@app.route('/api/v1/records', methods=['GET'])
+def api_records_list():
+    """Список записей с фильтрами /admin/records; ?limit=&after= - постранично по курсору."""
+    filters = get_records_filters(request.args)
+    limit = min(max(request.args.get('limit', type=int, default=API_PAGE_LIMIT), 1), API_MAX_LIMIT)
+    rows, next_token, _ = fetch_records_page(
+        get_db(), API_RECORD_COLUMNS, filters, limit,
+        after=request.args.get('after'), before=request.args.get('before'))
+    return jsonify({"items": [record_to_json(r) for r in rows], "next": next_token})
+
+@app.route('/api/v1/records/<int:id>', methods=['GET'])
+def api_record_get(id):
+    row = get_db().execute(f"SELECT {API_RECORD_COLUMNS} {RECORDS_FROM_SQL} WHERE r.id=?", (id,)).fetchone()
+    if not row:
+        raise ApiError("запись не найдена", 404)
+    return jsonify(record_to_json(row))
+
+@app.route('/api/v1/records', methods=['POST'])
+def api_records_create():
+    """Пакетное создание: [{date, machine_id, driver_id, status, ...}, ...] -> {"ids": [...]}"""
+    items = api_json_list("items")
+    conn = get_db()
+    created = get_next_free_ids(conn, "records", len(items))
+    def run(index, item):
+        conn.execute('''
+            INSERT INTO records
+            (id,date,machine_id,driver_id,status,start_time,end_time,hours,minutes,comment,counterparty_id)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ''', (created[index], *validate_record_json(item)))
+    api_apply_batch(conn, items, run)
+    return jsonify({"ids": created}), 201
+
+@app.route('/api/v1/records', methods=['PATCH'])
+def api_records_update():
+    """Пакетное обновление: [{id, поля...}, ...]; неуказанные поля не меняются."""
+    items = api_json_list("items")
+    conn = get_db()
+    def run(index, item):
+        if not isinstance(item, dict) or "id" not in item:
+            raise ValueError("не указан id")
+        row = conn.execute(
+            f"SELECT {', '.join(RECORD_FIELDS)} FROM records WHERE id=?", (item["id"],)
+        ).fetchone()
+        if row is None:
+            raise ValueError(f"запись {item['id']} не найдена")
+        conn.execute('''
+            UPDATE records
+               SET date=?, machine_id=?, driver_id=?, status=?, start_time=?, end_time=?,
+                   hours=?, minutes=?, comment=?, counterparty_id=?
+             WHERE id=?
+        ''', (*validate_record_json(item, dict(zip(RECORD_FIELDS, row))), item["id"]))
+    api_apply_batch(conn, items, run)
+    return jsonify({"updated": len(items)})
+
+@app.route('/api/v1/records', methods=['DELETE'])
+def api_records_delete():
+    """Пакетное удаление: {"ids": [...]} или [...]."""
+    ids = api_json_list("ids")
+    conn = get_db()
+    def run(index, id_):
+        if conn.execute("DELETE FROM records WHERE id=?", (int(id_),)).rowcount==0:
+            raise ValueError(f"запись {id_} не найдена")
+    api_apply_batch(conn, ids, run)
+    return jsonify({"deleted": len(ids)})
+
+def register_ref_api(table):
+    """GET/POST/PATCH/DELETE /api/v1/<table> для справочника (id, name)."""
+    def list_view():
+        return jsonify([{"id": r[0], "name": r[1]} for r in get_ref_data(get_db())[table]['rows']])
+
+    def get_view(id):
+        row = get_db().execute(f"SELECT id, name FROM {table} WHERE id=?", (id,)).fetchone()
+        if not row:
+            raise ApiError("не найдено", 404)
+        return jsonify({"id": row[0], "name": row[1]})
+
+    def create_view():
+        items = api_json_list("items")
+        conn = get_db()
+        created = get_next_free_ids(conn, table, len(items))
+        def run(index, item):
+            name = str(item["name"]).strip()
+            if not name:
+                raise ValueError("пустое имя")
+            conn.execute(f"INSERT INTO {table} (id,name) VALUES (?,?)", (created[index], name))
+        api_apply_batch(conn, items, run)
+        return jsonify({"ids": created}), 201
+
+    def update_view():
+        items = api_json_list("items")
+        conn = get_db()
+        def run(index, item):
+            name = str(item["name"]).strip()
+            if not name:
+                raise ValueError("пустое имя")
+            if conn.execute(f"UPDATE {table} SET name=? WHERE id=?", (name, int(item["id"]))).rowcount==0:
+                raise ValueError(f"id {item['id']} не найден")
+        api_apply_batch(conn, items, run)
+        return jsonify({"updated": len(items)})
+
+    def delete_view():
+        ids = api_json_list("ids")
+        conn = get_db()
+        def run(index, id_):
+            if conn.execute(f"DELETE FROM {table} WHERE id=?", (int(id_),)).rowcount==0:
+                raise ValueError(f"id {id_} не найден")
+        api_apply_batch(conn, ids, run)
+        return jsonify({"deleted": len(ids)})
+
+    url = f"/api/v1/{table}"
+    app.add_url_rule(url, f"api_{table}_list", list_view, methods=['GET'])
+    app.add_url_rule(f"{url}/<int:id>", f"api_{table}_get", get_view, methods=['GET'])
+    app.add_url_rule(url, f"api_{table}_create", create_view, methods=['POST'])
+    app.add_url_rule(url, f"api_{table}_update", update_view, methods=['PATCH'])
+    app.add_url_rule(url, f"api_{table}_delete", delete_view, methods=['DELETE'])
+
+for _table in REF_TABLES:
+    register_ref_api(_table)
+
+# Схема и индексы проверяются при каждом старте, в том числе воркеров gunicorn
+init_db()
 
 if __name__=='__main__':
-    init_db()
     app.run(host='0.0.0.0', port=5000, debug=True)
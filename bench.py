@@ -0,0 +1,289 @@
+"""Нагрузочный замер горячих маршрутов на синтетической базе.
+
+Пример:
+    python bench.py --machines 100 --years 5 --output bench_results.json
+
+Создаёт an30-базу с заданным числом техники/водителей/контрагентов и записей,
+прогоняет маршруты через тестовый клиент Flask и пишет в JSON перцентили
+задержки, число SQL-запросов и пиковую память по каждому маршруту.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import app as an30
+
+COMMENTS = ["копали траншею", "планировка площадки", "замена гидравлического шланга",
+            "ожидание материала", "погрузка грунта", "ремонт ходовой", ""]
+
+
+def generate_db(path, machines, drivers, counterparties, years, per_day, seed):
+    """Синтетическая база: на каждую технику per_day записей в день за years лет."""
+    an30.app.config['DATABASE'] = path
+    an30.init_db()
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO machines (id,name) VALUES (?,?)",
+                     [(i, f"Техника {i:03d}") for i in range(1, machines+1)])
+    conn.executemany("INSERT INTO drivers (id,name) VALUES (?,?)",
+                     [(i, f"Водитель {i:03d}") for i in range(1, drivers+1)])
+    conn.executemany("INSERT INTO counterparties (id,name) VALUES (?,?)",
+                     [(i, f"Контрагент {i:03d}") for i in range(1, counterparties+1)])
+
+    start = date.today()-timedelta(days=365*years)
+    statuses = ["work"]*7+["stop", "repair", "holiday"]
+
+    def rows():
+        rec_id = 0
+        for day in range(365*years):
+            d = str(start+timedelta(days=day))
+            for m in range(1, machines+1):
+                for _ in range(per_day):
+                    rec_id += 1
+                    st_h = rnd.randint(6, 10)
+                    en_h = st_h+rnd.randint(4, 12)
+                    st, en = f"{st_h:02d}:{rnd.choice((0, 30)):02d}", f"{en_h % 24:02d}:{rnd.choice((0, 15, 45)):02d}"
+                    yield (rec_id, d, m, rnd.randint(1, drivers), rnd.choice(statuses), st, en,
+                           *an30.record_durations(st, en), rnd.choice(COMMENTS),
+                           rnd.choice([None, rnd.randint(1, counterparties)]))
+
+    conn.executemany('''
+        INSERT INTO records
+        (id,date,machine_id,driver_id,status,start_time,end_time,hours,minutes,comment,counterparty_id)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+    ''', rows())
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values)-1)*p/100
+    lo = int(k)
+    hi = min(lo+1, len(values)-1)
+    return values[lo]+(values[hi]-values[lo])*(k-lo)
+
+
+class SqlCounter:
+    """Считает SQL-операторы всех соединений, открытых через an30.connect_db."""
+
+    def __init__(self):
+        self.count = 0
+        self._orig = an30.connect_db
+
+    def _connect(self):
+        conn = self._orig()
+        conn.set_trace_callback(self._trace)
+        return conn
+
+    def _trace(self, sql):
+        self.count += 1
+
+    def __enter__(self):
+        an30.connect_db = self._connect
+        return self
+
+    def __exit__(self, *exc):
+        an30.connect_db = self._orig
+
+
+def run_case(client, name, make_request, repeat):
+    """Прогон одного маршрута repeat раз; make_request(i) -> ответ тестового клиента."""
+    latencies = []
+    queries = []
+    statuses = set()
+    for i in range(repeat):
+        with SqlCounter() as counter:
+            t0 = time.perf_counter()
+            response = make_request(client, i)
+            response.get_data()
+            elapsed = time.perf_counter()-t0
+            response.close()
+        latencies.append(elapsed*1000)
+        queries.append(counter.count)
+        statuses.add(response.status_code)
+
+    # Память - отдельным прогоном: tracemalloc заметно замедляет код и исказил бы задержки
+    tracemalloc.start()
+    response = make_request(client, repeat)
+    response.get_data()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    response.close()
+    return {
+        "route": name,
+        "repeat": repeat,
+        "status_codes": sorted(statuses),
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+            "mean": sum(latencies)/len(latencies),
+        },
+        "sql_statements": {"mean": sum(queries)/len(queries), "max": max(queries)},
+        "peak_memory_bytes": peak,
+    }
+
+
+def build_cases(args, start):
+    rnd = random.Random(args.seed+1)
+    months = [(start.year+(start.month-1+i)//12, (start.month-1+i) % 12+1) for i in range(12*args.years)]
+
+    def calendar(client, i):
+        y, m = rnd.choice(months)
+        return client.get(f"/calendar/{rnd.randint(1, args.machines)}?year={y}&month={m}")
+
+    def calendar_year(client, i):
+        y = rnd.choice(months)[0]
+        return client.get(f"/calendar/{rnd.randint(1, args.machines)}?view=year&year={y}")
+
+    def fleet_calendar(client, i):
+        y, m = rnd.choice(months)
+        return client.get(f"/calendar?year={y}&month={m}")
+
+    def admin_records(client, i):
+        return client.get("/admin/records")
+
+    def admin_records_filtered(client, i):
+        return client.get(f"/admin/records?driv={rnd.randint(1, args.drivers)}&status=work&sort=hours_desc")
+
+    def admin_records_deep(client, i):
+        # Десять страниц подряд по курсору next
+        url = "/admin/records?sort=date_asc"
+        response = None
+        for _ in range(10):
+            if response is not None:
+                response.close()
+            response = client.get(url)
+            text = response.get_data(as_text=True)
+            marker = text.find("after=")
+            if marker < 0:
+                break
+            url = "/admin/records"+text[text.rfind('"', 0, marker)+1:text.find('"', marker)].replace("&amp;", "&")
+        return response
+
+    def admin_records_comment(client, i):
+        return client.get("/admin/records?comment_sub=гидравл")
+
+    def export_filtered(client, i):
+        return client.get(f"/export?export=filtered&mach={rnd.randint(1, args.machines)}")
+
+    def export_csv(client, i):
+        return client.get(f"/export.csv?mach={rnd.randint(1, args.machines)}")
+
+    def insert_record(client, i):
+        return client.post("/admin/records", data={
+            # Дни после конца данных: проверка пересечений проходит, запись вставляется
+            "date": str(start+timedelta(days=365*args.years+i)),
+            "machine_id": rnd.randint(1, args.machines),
+            "driver_id": rnd.randint(1, args.drivers),
+            "status": "work", "start_time": "08:00", "end_time": "17:30",
+            "comment": "bench", "counterparty_id": "",
+        })
+
+    cases = [
+        ("calendar", calendar, args.repeat),
+        ("calendar_year", calendar_year, args.repeat),
+        ("fleet_calendar", fleet_calendar, args.repeat),
+        ("admin_records", admin_records, args.repeat),
+        ("admin_records_filtered", admin_records_filtered, args.repeat),
+        ("admin_records_10_pages", admin_records_deep, max(1, args.repeat//10)),
+        ("admin_records_comment", admin_records_comment, args.repeat),
+        ("export_excel_machine", export_filtered, max(1, args.repeat//10)),
+        ("export_csv_machine", export_csv, max(1, args.repeat//10)),
+        ("insert_record", insert_record, args.repeat),
+    ]
+    if args.full_export:
+        cases.append(("export_excel_all", lambda client, i: client.get("/export"), 1))
+    return cases
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер маршрутов АН-30 на синтетических данных")
+    parser.add_argument("--machines", type=int, default=100)
+    parser.add_argument("--drivers", type=int, default=150)
+    parser.add_argument("--counterparties", type=int, default=40)
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--per-day", type=int, default=1, help="записей на технику в день")
+    parser.add_argument("--repeat", type=int, default=50, help="повторов на маршрут")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="путь к базе (по умолчанию - временный файл)")
+    parser.add_argument("--reuse-db", action="store_true", help="не генерировать, если база уже есть")
+    parser.add_argument("--full-export", action="store_true", help="замерить и выгрузку всех записей")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    tmpdir = None
+    path = args.db
+    if not path:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "an30.db")
+
+    t0 = time.perf_counter()
+    if args.reuse_db and os.path.exists(path):
+        an30.app.config['DATABASE'] = path
+        an30.init_db()
+        first = sqlite3.connect(path).execute("SELECT MIN(date) FROM records").fetchone()[0]
+        start = date.fromisoformat(first) if first else date.today()
+    else:
+        if os.path.exists(path):
+            os.remove(path)
+        start = generate_db(path, args.machines, args.drivers, args.counterparties,
+                            args.years, args.per_day, args.seed)
+    generate_s = time.perf_counter()-t0
+    total_records = sqlite3.connect(path).execute("SELECT COUNT(*) FROM records").fetchone()[0]
+    print(f"База: {path}, записей: {total_records}, подготовка {generate_s:.1f} с")
+
+    client = an30.app.test_client()
+    results = []
+    for name, make_request, repeat in build_cases(args, start):
+        res = run_case(client, name, make_request, repeat)
+        results.append(res)
+        lat = res["latency_ms"]
+        print(f"{name:28s} p50={lat['p50']:8.1f} мс  p99={lat['p99']:8.1f} мс  "
+              f"sql={res['sql_statements']['mean']:6.1f}  пик={res['peak_memory_bytes']/1e6:7.1f} МБ")
+
+    report = {
+        "git_revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "dataset": {
+            "machines": args.machines, "drivers": args.drivers,
+            "counterparties": args.counterparties, "years": args.years,
+            "per_day": args.per_day, "records": total_records, "seed": args.seed,
+            "generate_seconds": generate_s,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты: {args.output}")
+    if tmpdir:
+        tmpdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
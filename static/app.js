@@ -0,0 +1,49 @@
+function confirmDelete(msg) {
+    return confirm(msg || 'Вы уверены что хотите удалить запись?');
+}
+function sortBy(sortField) {
+    const url = new URL(window.location.href);
+    let currentSort = url.searchParams.get('sort');
+    if (currentSort === sortField + '_asc') {
+        url.searchParams.set('sort', sortField + '_desc');
+    } else {
+        url.searchParams.set('sort', sortField + '_asc');
+    }
+    window.location.href = url.toString();
+}
+function pollExportJob(box) {
+    const bar = box.querySelector('progress');
+    const text = box.querySelector('.job-text');
+    const link = box.querySelector('.job-download');
+    fetch(box.dataset.jobStatus).then(r => r.json()).then(job => {
+        bar.value = job.progress;
+        if (job.status === 'done') {
+            text.textContent = 'Готово: ' + job.total_rows + ' строк';
+            link.hidden = false;
+            window.location.href = job.download_url;
+        } else if (job.status === 'failed' || job.error) {
+            text.textContent = 'Ошибка: ' + (job.error || 'задание не найдено');
+        } else {
+            text.textContent = job.total_rows ? job.done_rows + ' из ' + job.total_rows + ' строк' : 'В очереди...';
+            setTimeout(() => pollExportJob(box), 1000);
+        }
+    }).catch(() => setTimeout(() => pollExportJob(box), 3000));
+}
+document.querySelectorAll('[data-job-status]').forEach(pollExportJob);
+function loadCalendarDay(table, cell) {
+    const box = document.getElementById('day-detail');
+    table.querySelectorAll('.heat-selected').forEach(c => c.classList.remove('heat-selected'));
+    cell.classList.add('heat-selected');
+    box.hidden = false;
+    box.textContent = 'Загрузка...';
+    fetch(table.dataset.dayUrl + cell.dataset.day)
+        .then(r => r.ok ? r.text() : Promise.reject(r.status))
+        .then(html => { box.innerHTML = html; })
+        .catch(() => { box.textContent = 'Не удалось загрузить день'; });
+}
+document.querySelectorAll('.heat-calendar').forEach(table => {
+    table.addEventListener('click', e => {
+        const cell = e.target.closest('[data-day]');
+        if (cell) loadCalendarDay(table, cell);
+    });
+});
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as an30
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """Тестовый клиент на пустой базе во временном каталоге."""
+    monkeypatch.setitem(an30.app.config, 'DATABASE', str(tmp_path/'an30.db'))
+    monkeypatch.setitem(an30.app.config, 'TESTING', True)
+    an30.init_db()
+    with an30.app.test_client() as c:
+        yield c
+
+
+@pytest.fixture
+def refs(client):
+    """Одна техника и один водитель: (machine_id, driver_id)."""
+    client.post('/admin/machines', data={'name': 'Экскаватор'})
+    client.post('/admin/drivers', data={'name': 'Иванов'})
+    return 1, 1
+
+
+def record_form(**overrides):
+    form = {
+        'date': '2025-03-10', 'machine_id': '1', 'driver_id': '1', 'status': 'work',
+        'start_time': '08:00', 'end_time': '17:00', 'comment': '', 'counterparty_id': '',
+    }
+    form.update(overrides)
+    return form
@@ -0,0 +1,34 @@
+import sqlite3
+
+import analytics
+
+
+def make_conn(rows):
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE records (date TEXT, machine_id INTEGER, status TEXT, minutes INTEGER)")
+    conn.executemany("INSERT INTO records VALUES (?,?,?,?)", rows)
+    return conn
+
+
+def test_month_periods_are_clamped_to_range():
+    conn = make_conn([('2025-01-20', 1, 'work', 60), ('2025-02-10', 1, 'work', 60),
+                      ('2025-03-10', 1, 'stop', 60), ('2025-04-03', 1, 'work', 60)])
+    report = analytics.utilization(conn, '2025-01-15', '2025-04-05', [1], 'month')
+    assert report['periods'] == ['2025-01-15', '2025-02-01', '2025-03-01', '2025-04-01']
+    assert [(r['start'], r['end'], r['days'], r['partial']) for r in report['period_ranges']] == [
+        ('2025-01-15', '2025-01-31', 17, True),
+        ('2025-02-01', '2025-02-28', 28, False),
+        ('2025-03-01', '2025-03-31', 31, False),
+        ('2025-04-01', '2025-04-05', 5, True),
+    ]
+    trends = [c['trend'] for c in report['machines'][0]['periods']]
+    # Только март к февралю: оба месяца полные
+    assert trends == [None, None, -100.0, None]
+
+
+def test_week_periods_start_at_range_start():
+    conn = make_conn([])
+    report = analytics.utilization(conn, '2025-01-01', '2025-01-14', [1], 'week')
+    # 2025-01-01 - среда
+    assert report['periods'] == ['2025-01-01', '2025-01-06', '2025-01-13']
+    assert [r['partial'] for r in report['period_ranges']] == [True, False, True]
@@ -0,0 +1,30 @@
+import app as an30
+
+
+def machine_ids(client):
+    with an30.app.app_context():
+        return [r[0] for r in an30.get_db().execute("SELECT id FROM machines ORDER BY id")]
+
+
+def test_monotonic_does_not_reuse_deleted_top_id(client, monkeypatch):
+    monkeypatch.setitem(an30.app.config, 'ID_ALLOCATION', 'monotonic')
+    for name in ('A', 'B', 'C'):
+        client.post('/admin/machines', data={'name': name})
+    assert machine_ids(client) == [1, 2, 3]
+
+    client.post('/delete/machine/3')
+    client.post('/admin/machines', data={'name': 'D'})
+    assert machine_ids(client) == [1, 2, 4]
+
+    with an30.app.app_context():
+        conn = an30.get_db()
+        assert an30.get_next_free_ids(conn, 'machines', 2) == [5, 6]
+        conn.rollback()
+
+
+def test_reuse_fills_gaps(client):
+    for name in ('A', 'B', 'C'):
+        client.post('/admin/machines', data={'name': name})
+    client.post('/delete/machine/2')
+    client.post('/admin/machines', data={'name': 'D'})
+    assert machine_ids(client) == [1, 2, 3]
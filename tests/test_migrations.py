@@ -0,0 +1,28 @@
+import sqlite3
+
+import app as an30
+
+
+def test_minutes_backfill_for_old_schema(tmp_path, monkeypatch):
+    path = str(tmp_path/'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE records (
+            id INTEGER PRIMARY KEY, date TEXT NOT NULL, machine_id INTEGER, driver_id INTEGER,
+            start_time TEXT, end_time TEXT, hours INTEGER, comment TEXT, counterparty_id INTEGER,
+            status TEXT NOT NULL
+        )
+    ''')
+    conn.executemany("INSERT INTO records (id,date,start_time,end_time,hours,status) VALUES (?,?,?,?,?,?)", [
+        (1, '2025-01-01', '08:00', '17:30', None, 'work'),
+        (2, '2025-01-02', None, None, None, 'holiday'),
+        (3, '2025-01-03', '22:00', '02:15', 4, 'work'),
+    ])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setitem(an30.app.config, 'DATABASE', path)
+    an30.init_db()
+    conn = sqlite3.connect(path)
+    assert conn.execute("SELECT id, hours, minutes FROM records ORDER BY id").fetchall() == [
+        (1, 9, 570), (2, 0, 0), (3, 4, 255)]
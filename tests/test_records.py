@@ -0,0 +1,52 @@
+import app as an30
+from conftest import record_form
+
+
+def test_records_page_sql_trace(client, refs, monkeypatch):
+    monkeypatch.setitem(an30.app.config, 'SQL_TRACE', True)
+    client.post('/admin/records', data=record_form())
+
+    response = client.get('/admin/records?sql_trace=1')
+    assert response.status_code == 200
+    assert int(response.headers['X-SQL-Queries']) > 0
+    html = response.get_data(as_text=True)
+    assert 'class="container sql-trace"' in html
+    assert 'FROM records r' in html
+
+
+def records(client):
+    with an30.app.app_context():
+        return an30.get_db().execute("SELECT date, start_time, end_time FROM records ORDER BY id").fetchall()
+
+
+def test_insert_rejects_bad_date(client, refs):
+    response = client.post('/admin/records', data=record_form(date='2025-02-30'))
+    assert response.status_code == 400
+    assert records(client) == []
+
+
+def test_insert_rejects_bad_time(client, refs):
+    response = client.post('/admin/records', data=record_form(start_time='25:00'))
+    assert response.status_code == 400
+    assert records(client) == []
+
+
+def test_insert_normalizes_time(client, refs):
+    client.post('/admin/records', data=record_form(start_time='7:30'))
+    assert records(client) == [('2025-03-10', '07:30', '17:00')]
+
+
+def test_edit_rejects_bad_date(client, refs):
+    client.post('/admin/records', data=record_form())
+    response = client.post('/edit/record/1', data=record_form(date='10.13.2025'))
+    assert response.status_code == 400
+    assert records(client) == [('2025-03-10', '08:00', '17:00')]
+
+
+def test_edit_rejects_bad_time(client, refs):
+    client.post('/admin/records', data=record_form())
+    response = client.post('/edit/record/1', data=record_form(end_time='17:99'))
+    assert response.status_code == 400
+    assert records(client) == [('2025-03-10', '08:00', '17:00')]
+    # Блокировка записи снята: следующая вставка проходит
+    assert client.post('/admin/records', data=record_form(date='2025-03-11')).status_code == 302
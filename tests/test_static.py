@@ -0,0 +1,18 @@
+import app as an30
+
+
+def test_current_version_is_immutable(client):
+    with an30.app.test_request_context():
+        url = an30.static_url('app.css')
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == an30.STATIC_MAX_AGE
+
+
+def test_unknown_version_is_not_cached(client):
+    response = client.get('/static/app.css?v=stale0000000')
+    assert response.status_code == 200
+    assert response.cache_control.no_cache
+    assert not response.cache_control.immutable
+    assert response.cache_control.max_age is None
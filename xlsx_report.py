@@ -0,0 +1,159 @@
+"""Книга Excel "лист на каждую технику" со сводным листом.
+
+Листы техники строятся параллельно в отдельных процессах (write-only, каждый
+в свой временный xlsx), затем вместе с книгой-каркасом (сводный лист и пустые
+листы с нужными именами) собираются в один файл: XML листа просто переносится
+из части в каркас. Так можно, потому что openpyxl пишет строки inline (без
+общей таблицы sharedStrings), а стили во всех книгах регистрируются в одном
+порядке (add_export_styles), и номера стилей в ячейках совпадают.
+
+Модуль не импортирует app: его функции выполняются в дочерних процессах.
+"""
+import os
+import re
+import shutil
+import sqlite3
+import zipfile
+from datetime import datetime
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, NamedStyle, PatternFill
+from openpyxl.utils import get_column_letter
+
+HEADER_STYLE = "export_header"
+SHEET_TITLE_MAX = 31
+SHEET_TITLE_BAD = re.compile(r"[\[\]:*?/\\]")
+
+
+def add_export_styles(wb, status_colors, ws):
+    """Именованные стили выгрузки (заголовок и статусы), номера стилей - в фиксированном порядке.
+
+    openpyxl выдаёт номер стилю при первом использовании; здесь все стили
+    используются сразу на пустых ячейках листа ws, поэтому номера одинаковы
+    в любой книге с теми же status_colors.
+    """
+    header_style = NamedStyle(name=HEADER_STYLE)
+    header_style.fill = PatternFill(start_color="444444", fill_type="solid")
+    header_style.font = Font(color="FFFFFF", bold=True)
+    wb.add_named_style(header_style)
+    names = [HEADER_STYLE]
+    for status, color in status_colors.items():
+        st = NamedStyle(name=f"status_{status}")
+        st.fill = PatternFill(start_color=color[1:], fill_type="solid")
+        wb.add_named_style(st)
+        names.append(st.name)
+    for name in names:
+        cell = WriteOnlyCell(ws)
+        cell.style = name
+        cell.style_id
+
+
+def header_row(ws, headers):
+    row = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.style = HEADER_STYLE
+        row.append(cell)
+    return row
+
+
+def format_date(date_db):
+    """'YYYY-MM-DD' -> 'ДД.ММ.ГГГГ'; прочее - как есть. Используется и в app."""
+    try:
+        return datetime.strptime(date_db, '%Y-%m-%d').strftime('%d.%m.%Y')
+    except (TypeError, ValueError):
+        return date_db
+
+
+def write_records_sheet(ws, rows, headers, status_colors):
+    """Заголовок и строки выгрузки: date, machine, driver, status, start, end, hours, cparty, comment."""
+    for col in range(1, len(headers)+1):
+        ws.column_dimensions[get_column_letter(col)].width = 20
+    ws.append(header_row(ws, headers))
+    for row in rows:
+        status = row[3]
+        scell = WriteOnlyCell(ws, value=status.capitalize())   # столбец "Статус"
+        if status in status_colors:
+            scell.style = f"status_{status}"
+        ws.append([format_date(row[0]), row[1], row[2], scell, row[4], row[5], row[6], row[7], row[8]])
+
+
+def sheet_titles(names, reserved=()):
+    """Допустимые и неповторяющиеся имена листов Excel (до 31 символа, без []:*?/\\)."""
+    used = {t.lower() for t in reserved}
+    titles = []
+    for name in names:
+        base = SHEET_TITLE_BAD.sub("_", str(name)).strip() or "Лист"
+        title = base[:SHEET_TITLE_MAX]
+        n = 2
+        while title.lower() in used:
+            suffix = f" ({n})"
+            title = base[:SHEET_TITLE_MAX-len(suffix)]+suffix
+            n += 1
+        used.add(title.lower())
+        titles.append(title)
+    return titles
+
+
+def render_sheet(task):
+    """Дочерний процесс: записи одной техники -> отдельный xlsx из одного листа."""
+    db_path, sql, params, title, headers, status_colors, out_path, chunk_size = task
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        cur = conn.execute(sql, params)
+
+        def rows():
+            while True:
+                chunk = cur.fetchmany(chunk_size)
+                if not chunk:
+                    break
+                yield from chunk
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title)
+        add_export_styles(wb, status_colors, ws)
+        write_records_sheet(ws, rows(), headers, status_colors)
+        wb.save(out_path)
+    finally:
+        conn.close()
+    return out_path
+
+
+def build_workbook(fileobj, pool, tmpdir, summary, sheets, db_path, headers, status_colors, chunk_size=1000):
+    """Собирает книгу: лист summary = (title, headers, rows), затем листы sheets = [(title, sql, params)].
+
+    Листы sheets строятся в пуле процессов pool; временные файлы - в tmpdir.
+    """
+    tasks = [
+        (db_path, sql, list(params), title, headers, status_colors, os.path.join(tmpdir, f"part{i}.xlsx"), chunk_size)
+        for i, (title, sql, params) in enumerate(sheets)
+    ]
+    futures = [pool.submit(render_sheet, task) for task in tasks]
+
+    # Пока части строятся - каркас: сводный лист и пустые листы с теми же стилями
+    skeleton_path = os.path.join(tmpdir, "skeleton.xlsx")
+    wb = Workbook(write_only=True)
+    summary_title, summary_headers, summary_rows = summary
+    ws = wb.create_sheet(summary_title)
+    add_export_styles(wb, status_colors, ws)
+    for col in range(1, len(summary_headers)+1):
+        ws.column_dimensions[get_column_letter(col)].width = 20 if col==1 else 14
+    ws.append(header_row(ws, summary_headers))
+    for row in summary_rows:
+        ws.append(row)
+    for title, _, _ in sheets:
+        wb.create_sheet(title)
+    wb.save(skeleton_path)
+
+    parts = {f"xl/worksheets/sheet{i+2}.xml": f.result() for i, f in enumerate(futures)}
+    with zipfile.ZipFile(skeleton_path) as skeleton, \
+            zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED) as out:
+        for item in skeleton.infolist():
+            if item.filename in parts:
+                with zipfile.ZipFile(parts[item.filename]) as part, \
+                        part.open("xl/worksheets/sheet1.xml") as src, \
+                        out.open(item.filename, "w") as dst:
+                    shutil.copyfileobj(src, dst, 1024*1024)
+            else:
+                out.writestr(item, skeleton.read(item.filename))